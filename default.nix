@@ -81,9 +81,11 @@ rec {
     inherit statx;
     inherit pyfst;
     inherit python-dynamodb-lock;
+    orjson = unstable.python38Packages.orjson;
   };
   nixbot-frontend = pkgs.python38.pkgs.callPackage ./nixbot-frontend {
     inherit nixbot-common;
     aiostream = unstable.python38Packages.aiostream;
+    orjson = unstable.python38Packages.orjson;
   };
 }
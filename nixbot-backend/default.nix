@@ -28,6 +28,8 @@
 , systemd
 , awscli2
 , psycopg2
+, requests
+, orjson
 }:
 
 buildPythonApplication {
@@ -53,6 +55,8 @@ buildPythonApplication {
     precedence-constrained-knapsack
     python-dynamodb-lock
     psycopg2
+    requests
+    orjson
   ];
 
   doCheck = true;
@@ -66,8 +70,8 @@ buildPythonApplication {
   ];
 
   checkPhase = ''
-    # echo -e "\x1b[32m## run unittest\x1b[0m"
-    # py.test .
+    echo -e "\x1b[32m## run unittest\x1b[0m"
+    py.test tests/
     echo -e "\x1b[32m## run isort\x1b[0m"
     isort -df -rc --lines 999 src/
     echo -e "\x1b[32m## run black\x1b[0m"
@@ -1,18 +1,24 @@
 from __future__ import annotations
 
 import argparse
+import functools
 import json
 import os
 import shutil
+import signal
 import subprocess
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from glob import glob
-from typing import Dict, Iterator, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import boto3
+import boto3.session
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import supervise_api
 from loguru import logger as log
 from nixbot_common import (
@@ -23,6 +29,7 @@ from nixbot_common import (
 from systemd.journal import sendv
 from typing_extensions import TypedDict
 
+_BASE_PATH = os.environ["PATH"]
 SYSTEM = os.uname().machine
 assert SYSTEM in ("aarch64", "x86_64")
 IDLE_CUTOFF = timedelta(minutes=15)
@@ -38,6 +45,28 @@ SILENT_TIMEOUT = timedelta(hours=2)
 # Give some extra time before killing the process
 NIXPKGS_REVIEW_TIMEOUT = BUILD_TIMEOUT + timedelta(minutes=10)
 
+_IDLE_CUTOFF_S = IDLE_CUTOFF.total_seconds()
+_BUILD_TIMEOUT_S = BUILD_TIMEOUT.total_seconds()
+_SILENT_TIMEOUT_S = SILENT_TIMEOUT.total_seconds()
+_NIXPKGS_REVIEW_TIMEOUT_S = NIXPKGS_REVIEW_TIMEOUT.total_seconds()
+
+# Take one PR at a time: builds run for hours, and anything received but not
+# yet built is invisible to the other backends in the autoscaling group.
+# ReceiveMessage long-polls for at most 20s.
+SQS_MAX_NUMBER_OF_MESSAGES = 1
+SQS_WAIT_TIME_SECONDS = 20
+
+# Only garbage collect the nix store every few builds, unless it's getting full
+GC_EVERY_N_BUILDS = 5
+GC_DISK_USAGE_THRESHOLD = 0.80
+
+# Directories are moved in here and then deleted in the background, so that
+# deleting nixpkgs checkouts doesn't hold up the next build.
+TRASH_DIR = os.path.expanduser("~/.cache/nixpkgs-review-trash")
+_rmtree_executor = ThreadPoolExecutor(max_workers=1)
+
+_postgres_pool: Any = None
+
 SQSMessage = TypedDict(
     "SQSMessage",
     {
@@ -47,6 +76,14 @@ SQSMessage = TypedDict(
 )
 
 
+class ShTimeout(Exception):
+    pass
+
+
+def _raise_sh_timeout(signum, frame):
+    raise ShTimeout()
+
+
 def sh(cmd: List[str], timeout: Optional[float], env: Dict[str, str] = None) -> int:
     """Note that env is a set of _updates_ to the environment, not the complete
     environment!
@@ -54,30 +91,51 @@ def sh(cmd: List[str], timeout: Optional[float], env: Dict[str, str] = None) ->
     # http://catern.com/posts/fork.html
 
     with supervise_api.Process(cmd, env=(env or {})) as proc:
-        start_time = time.time()
         if timeout is None:
             return proc.wait()
-        else:
-            while time.time() - start_time <= timeout:
-                try:
-                    time.sleep(0.1)
-                except RuntimeError:
-                    subprocess.run(["git", "worktree", "prune"])
-                    raise
-                returncode = proc.poll()
-                if returncode is not None:
-                    return returncode
+
+        # Block in wait() and let SIGALRM interrupt it on timeout, rather than
+        # waking up to poll the process.
+        prev_handler = signal.signal(signal.SIGALRM, _raise_sh_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return proc.wait()
+        except ShTimeout:
             log.error("BUILD TIMED OUT!")
             return -1  # indicate timeout
+        except RuntimeError:
+            subprocess.run(["git", "worktree", "prune"])
+            raise
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, prev_handler)
+
+
+def rmtree_in_background(path: str) -> None:
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    trash_path = os.path.join(
+        TRASH_DIR, f"{os.path.basename(path)}-{time.time_ns()}"
+    )
+    os.rename(path, trash_path)
+    _rmtree_executor.submit(shutil.rmtree, trash_path, ignore_errors=True)
+
+
+def empty_trash_in_background() -> None:
+    # Whatever is in here was left behind by a previous run that was killed
+    # before it finished deleting it
+    if not os.path.isdir(TRASH_DIR):
+        return
+    for entry in os.scandir(TRASH_DIR):
+        _rmtree_executor.submit(shutil.rmtree, entry.path, ignore_errors=True)
 
 
 def env_with(**kwargs: str) -> Dict[str, str]:
+    """Updates to the environment for sh(). `$PATH` or `${PATH}` in one of the
+    `kwargs` is replaced by our PATH; nothing else is expanded.
+    """
     env = {}
     for key, value in kwargs.items():
-        if "$PATH" in value:
-            value = value.replace("$PATH", os.environ["PATH"])
-        env[key] = value
-
+        env[key] = value.replace("${PATH}", _BASE_PATH).replace("$PATH", _BASE_PATH)
     return env
 
 
@@ -86,7 +144,7 @@ def build_pr(
 ) -> None:
     log.info("Starting build", pr=pr)
     for dirname in glob(os.path.expanduser(f"~/.cache/nixpkgs-review/pr-{pr}*")):
-        shutil.rmtree(dirname)
+        rmtree_in_background(dirname)
 
     if ofborg_url is not None:
         url = urllib.parse.urlparse(ofborg_url)
@@ -117,7 +175,7 @@ def build_pr(
         "--post-logs",
         # TODO: pass --system here
         "--build-args",
-        f"--timeout {int(BUILD_TIMEOUT.total_seconds())} --max-silent-time {int(SILENT_TIMEOUT.total_seconds())}",
+        f"--timeout {int(_BUILD_TIMEOUT_S)} --max-silent-time {int(_SILENT_TIMEOUT_S)}",
         "--run",
         os.environ["NIXPKGS_REVIEW_POST_BUILD_HOOK"],
     ]
@@ -128,7 +186,7 @@ def build_pr(
     start_time = time.time()
     sh(
         cmd,
-        timeout=NIXPKGS_REVIEW_TIMEOUT.total_seconds(),
+        timeout=_NIXPKGS_REVIEW_TIMEOUT_S,
         env=env_with(
             NIXPKGS_REVIEW_START_TIME=f"{start_time}",
             NIXPKGS_REVIEW_PR=f"{pr}",
@@ -138,11 +196,76 @@ def build_pr(
 
     nixpkgs_dir = os.path.expanduser(f"~/.cache/nixpkgs-review/pr-{pr}/nixpkgs")
     if os.path.exists(nixpkgs_dir):
-        shutil.rmtree(nixpkgs_dir)
+        rmtree_in_background(nixpkgs_dir)
     upload_s3(pr=pr, start_time=start_time)
     upload_postgres(pr=pr, start_time=start_time, database_url=database_url)
 
 
+def get_postgres_pool(database_url: str) -> Any:
+    global _postgres_pool
+    if _postgres_pool is None:
+        _postgres_pool = psycopg2.pool.ThreadedConnectionPool(1, 4, database_url)
+    return _postgres_pool
+
+
+def setup_postgres(database_url: Optional[str]) -> None:
+    if database_url is None:
+        return
+
+    pool = get_postgres_pool(database_url)
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as curs:
+            curs.execute(create_nixpkgs_review_finished_table_sql())
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+
+
+def insert_postgres_rows(database_url: str, rows: List[Tuple]) -> None:
+    SQL = """
+        INSERT INTO nixpkgs_review_finished(
+            build_elapsed,
+            ctime,
+            pull_request_number,
+            state,
+            system,
+            instance_type,
+            instance_id,
+            report
+        ) VALUES %s
+    """
+
+    pool = get_postgres_pool(database_url)
+    for attempt in range(2):
+        conn = pool.getconn()
+        ok = False
+        try:
+            with conn.cursor() as curs:
+                psycopg2.extras.execute_values(
+                    curs,
+                    SQL,
+                    rows,
+                    template="(make_interval(secs => %s), %s, %s, %s, %s, %s, %s, %s)",
+                )
+            conn.commit()
+            ok = True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The pooled connection sits idle for hours between builds, so the
+            # server (or a NAT in between) may have dropped it. Retry once on
+            # a fresh one.
+            if attempt > 0:
+                raise
+            log.warning("Postgres connection lost, reconnecting")
+        finally:
+            # A connection that failed gets discarded instead of reused
+            pool.putconn(conn, close=not ok)
+        if ok:
+            break
+
+    log.info("Uploaded to postgres", count=len(rows))
+
+
 def upload_postgres(pr: int, start_time: float, database_url: Optional[str]) -> None:
     if database_url is None:
         return
@@ -165,38 +288,30 @@ def upload_postgres(pr: int, start_time: float, database_url: Optional[str]) ->
         state = "crashed"
 
     metadata = get_ec2_metadata()
-    conn = psycopg2.connect(database_url)
+    # Written right away, so that a result isn't lost if this process dies
+    # before the next build finishes
+    row = (
+        (time.time() - start_time),
+        datetime.now().astimezone(),
+        pr,
+        state,
+        SYSTEM,
+        (metadata["instanceType"] if metadata is not None else ""),
+        (metadata["instanceId"] if metadata is not None else ""),
+        report_json_str,
+    )
+    insert_postgres_rows(database_url, [row])
 
-    SQL = """
-        INSERT INTO nixpkgs_review_finished(
-            build_elapsed,
-            ctime,
-            pull_request_number,
-            state,
-            system,
-            instance_type,
-            instance_id,
-            report
-        ) VALUES (make_interval(secs => %s), %s, %s, %s, %s, %s, %s, %s)
-    """
 
-    with conn.cursor() as curs:
-        curs.execute(create_nixpkgs_review_finished_table_sql())
-        curs.execute(
-            SQL,
-            (
-                (time.time() - start_time),
-                datetime.now().astimezone(),
-                pr,
-                state,
-                SYSTEM,
-                (metadata["instanceType"] if metadata is not None else ""),
-                (metadata["instanceId"] if metadata is not None else ""),
-                report_json_str,
-            ),
-        )
+@functools.lru_cache()
+def get_boto3_session() -> boto3.session.Session:
+    # One session (and so one set of credentials / endpoints) per process
+    return boto3.session.Session()
 
-    conn.commit()
+
+@functools.lru_cache()
+def get_s3_client() -> Any:
+    return get_boto3_session().client("s3")
 
 
 def upload_s3(pr: int, start_time: float) -> None:
@@ -212,15 +327,23 @@ def upload_s3(pr: int, start_time: float) -> None:
         report = f.read()
 
     if "NIXPKGS_REVIEW_DRY_RUN" not in os.environ:
-        s3 = boto3.client("s3")
-        s3.upload_file(file_name, bucket, object_name)
+        get_s3_client().upload_file(file_name, bucket, object_name)
     log.info("Finished build", pr=pr, report=report)
 
 
+@functools.lru_cache()
+def get_sqs_queue() -> Any:
+    # The Queue resource holds onto the resolved queue url, so caching it
+    # means we only pay for GetQueueUrl once.
+    sqs = get_boto3_session().resource("sqs")
+    return sqs.get_queue_by_name(QueueName=f"nixpkgs-buildbot-{SYSTEM}")
+
+
 def get_from_sqs() -> List:
-    sqs = boto3.resource("sqs")
-    queue = sqs.get_queue_by_name(QueueName=f"nixpkgs-buildbot-{SYSTEM}")
-    return queue.receive_messages(MaxNumberOfMessages=1, WaitTimeSeconds=20)
+    return get_sqs_queue().receive_messages(
+        MaxNumberOfMessages=SQS_MAX_NUMBER_OF_MESSAGES,
+        WaitTimeSeconds=SQS_WAIT_TIME_SECONDS,
+    )
 
 
 def deprovision_backend() -> None:
@@ -238,17 +361,17 @@ def deprovision_backend() -> None:
 
 
 def iter_sqs() -> Iterator[SQSMessage]:
-    last_sqs_message = time.time()
+    last_sqs_message = time.monotonic()
     while True:
         messages = get_from_sqs()
         log.info("Polled SQS", count=len(messages), messages=messages)
         if len(messages) > 0:
-            last_sqs_message = time.time()
+            last_sqs_message = time.monotonic()
 
         if (
             len(messages) == 0
             and last_sqs_message is not None
-            and time.time() - last_sqs_message > IDLE_CUTOFF.total_seconds()
+            and time.monotonic() - last_sqs_message > _IDLE_CUTOFF_S
         ):
             deprovision_backend()
             # don't return here. we might just die waiting, or maybe
@@ -271,6 +394,13 @@ def iter_sqs() -> Iterator[SQSMessage]:
             yield body
 
 
+def should_collect_garbage(builds_since_gc: int) -> bool:
+    if builds_since_gc >= GC_EVERY_N_BUILDS:
+        return True
+    disk = shutil.disk_usage("/nix")
+    return disk.used / disk.total > GC_DISK_USAGE_THRESHOLD
+
+
 def main() -> None:
     configure_logging()
     p = argparse.ArgumentParser()
@@ -293,15 +423,21 @@ def main() -> None:
             return
         yield from iter_sqs()
 
+    empty_trash_in_background()
+    setup_postgres(args.database_url)
+
+    builds_since_gc = 0
     for msg in source():
         assert "database_url" not in msg
         build_pr(database_url=args.database_url, **msg)
-        if not args.dry_run:
+        builds_since_gc += 1
+        if not args.dry_run and should_collect_garbage(builds_since_gc):
             subprocess.run(
                 ["nix-collect-garbage", "-d"],
                 check=True,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
             )
+            builds_since_gc = 0
 
     log.info("Finished")
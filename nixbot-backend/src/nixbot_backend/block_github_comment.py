@@ -3,8 +3,9 @@ from __future__ import annotations
 import json
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 from loguru import logger as log
 
@@ -27,6 +28,9 @@ GH_USER_BLOCKLIST = {
     "vbgl",
 }
 
+OOM_ENOSPC_UNIT = "oom-enospc-notify.service"
+EARLYOOM_UNIT = "earlyoom.service"
+
 
 def upload_blocked_due_to_blocklist(pr_user_login: str, rj: ReportJson) -> bool:
     if (pr_user_login in GH_USER_BLOCKLIST) and len(rj["failed"]) == 0:
@@ -34,29 +38,39 @@ def upload_blocked_due_to_blocklist(pr_user_login: str, rj: ReportJson) -> bool:
     return False
 
 
-def upload_blocked_oom_or_enospc():
+def oom_journal_entries() -> List[Dict[str, Any]]:
+    """Read the journald entries from both of the units that we check for
+    OOMs in a single pass.
+    """
     if "NIXPKGS_REVIEW_START_TIME" not in os.environ:
         log.error("NIXPKGS_REVIEW_START_TIME not set")
-        return False
+        return []
+
+    start_time = float(os.environ["NIXPKGS_REVIEW_START_TIME"])
+    journal = journald_logs_since(
+        dict(_SYSTEMD_UNIT=[OOM_ENOSPC_UNIT, EARLYOOM_UNIT]), start_time=start_time
+    )
+    return list(journal)
+
 
+def upload_blocked_oom_or_enospc(journal: List[Dict[str, Any]]) -> bool:
     def try_decode(entry: Dict[str, Any]) -> Dict[str, Any]:
         try:
             return json.loads(entry["MESSAGE"])
         except Exception:
             return {}
 
-    start_time = float(os.environ["NIXPKGS_REVIEW_START_TIME"])
-    journal = journald_logs_since(
-        dict(_SYSTEMD_UNIT="oom-enospc-notify.service"), start_time=start_time
-    )
-
-    messages = [try_decode(entry) for entry in journal]
+    messages = [
+        try_decode(entry)
+        for entry in journal
+        if entry.get("_SYSTEMD_UNIT") == OOM_ENOSPC_UNIT
+    ]
     if any(msg.get("event") in ("OOM Kill", "ENOSPC") for msg in messages):
         return True
     return False
 
 
-def upload_blocked_earlyoom():
+def upload_blocked_earlyoom(journal: List[Dict[str, Any]]) -> bool:
     # Mar 14 22:44:43 ip-10-0-15-194.ec2.internal systemd[1]: Started Early OOM killer.
     # Mar 14 22:44:43 ip-10-0-15-194.ec2.internal earlyoom[1024]: earlyoom 1.6.1
     # Mar 14 22:44:43 ip-10-0-15-194.ec2.internal earlyoom[1024]: Priority was raised successfully
@@ -73,15 +87,6 @@ def upload_blocked_earlyoom():
     # Mar 15 03:03:06 ip-10-0-13-27.ec2.internal earlyoom[1027]: sending SIGTERM to process 11827 uid 30001 "rustc": badness 949, VmRSS 1627 MiB
     # Mar 15 03:03:06 ip-10-0-13-27.ec2.internal earlyoom[1027]: process exited after 0.1 seconds
 
-    if "NIXPKGS_REVIEW_START_TIME" not in os.environ:
-        log.error("NIXPKGS_REVIEW_START_TIME not set")
-        return False
-
-    start_time = float(os.environ["NIXPKGS_REVIEW_START_TIME"])
-    journal = journald_logs_since(
-        dict(_SYSTEMD_UNIT="earlyoom.service"), start_time=start_time
-    )
-
     def is_kill(entry: Dict[str, Any]) -> bool:
         c1 = "sending SIGTERM to process" in entry["MESSAGE"]
         c2 = "sending SIGKILL to process" in entry["MESSAGE"]
@@ -90,7 +95,11 @@ def upload_blocked_earlyoom():
             return True
         return False
 
-    if any(is_kill(entry) for entry in journal):
+    if any(
+        is_kill(entry)
+        for entry in journal
+        if entry.get("_SYSTEMD_UNIT") == EARLYOOM_UNIT
+    ):
         return True
     return False
 
@@ -105,8 +114,10 @@ def upload_blocked_single_build(rj: ReportJson):
 
 
 def upload_blocked_disk_full(rj: ReportJson) -> bool:
+    if len(rj["failed"]) == 0:
+        return False
     disk = shutil.disk_usage("/nix")
-    if len(rj["failed"]) > 0 and (disk.used / disk.total > 0.95):
+    if disk.used / disk.total > 0.95:
         return True
     return False
 
@@ -147,14 +158,15 @@ def github_comment_is_editable(comment: Dict[str, Any]) -> bool:
 def is_blocked(report_json: ReportJson) -> bool:
     gh = GithubClient(os.environ.get("GITHUB_TOKEN"))
 
-    if upload_blocked_oom_or_enospc():
-        report_json["blocked_reason"] = "OOM_ENOSPC"
-        log.error("Upload blocked because I think there was an OOM or ENOSPC")
+    # Cheap checks that only look at the report go first
+    if upload_blocked_empty(report_json):
+        report_json["blocked_reason"] = "NO_PACKAGES_BUILT"
+        log.error("Upload blocked because no packages were built")
         return True
 
-    if upload_blocked_earlyoom():
-        report_json["blocked_reason"] = "EARLY_OOM"
-        log.error("Upload blocked because I think there was an Early OOM")
+    if upload_blocked_timed_out(report_json):
+        report_json["blocked_reason"] = "BUILD_TIMEOUT"
+        log.error("Upload blocked because there was a timeout")
         return True
 
     if upload_blocked_disk_full(report_json):
@@ -162,17 +174,27 @@ def is_blocked(report_json: ReportJson) -> bool:
         log.error("Upload blocked because I think the disk is full?")
         return True
 
-    if upload_blocked_empty(report_json):
-        report_json["blocked_reason"] = "NO_PACKAGES_BUILT"
-        log.error("Upload blocked because no packages were built")
+    # The rest of the checks need journald and github, which are independent
+    # of each other, so fetch them concurrently. Leaving the with-block waits
+    # for all of them, and any errors are raised by .result() below.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        oom_journal_future = executor.submit(oom_journal_entries)
+        github_future = executor.submit(
+            gh.pull_request_and_comments, report_json["pr"]
+        )
+
+    oom_journal = oom_journal_future.result()
+    if upload_blocked_oom_or_enospc(oom_journal):
+        report_json["blocked_reason"] = "OOM_ENOSPC"
+        log.error("Upload blocked because I think there was an OOM or ENOSPC")
         return True
 
-    if upload_blocked_timed_out(report_json):
-        report_json["blocked_reason"] = "BUILD_TIMEOUT"
-        log.error("Upload blocked because there was a timeout")
+    if upload_blocked_earlyoom(oom_journal):
+        report_json["blocked_reason"] = "EARLY_OOM"
+        log.error("Upload blocked because I think there was an Early OOM")
         return True
 
-    prev_gh_comments = gh.pull_request_comments(report_json["pr"])
+    pr_data, prev_gh_comments = github_future.result()
     is_second_build = any(github_comment_is_editable(c) for c in prev_gh_comments)
     is_first_build = not is_second_build
 
@@ -193,7 +215,6 @@ def is_blocked(report_json: ReportJson) -> bool:
         # Determine if the person who posted the PR has opted out from receiving
         # notifications with no build failures
         #
-        pr_data = gh.pull_request(report_json["pr"])
         if upload_blocked_due_to_blocklist(
             pr_data["user"]["login"], report_json
         ):
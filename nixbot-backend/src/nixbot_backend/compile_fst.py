@@ -1,22 +1,28 @@
 from __future__ import annotations
 
 import argparse
-import itertools
+import functools
 import re
 import sqlite3
 import statistics
+from collections import defaultdict
+from typing import DefaultDict, List
 
 import pyfst
 from humanize import naturalsize
 
+_VERSION_PART_RE = re.compile(r"[0-9\.]+$")
+_DIGITS_RE = re.compile(r"\d+")
 
+
+@functools.lru_cache(maxsize=1_000_000)
 def deversion_nix_drv_name(nix_name: str) -> str:
     parts = nix_name.split("-")
     new_parts = []
     for part in parts:
-        m = re.match(r"[0-9\.]+$", part)
+        m = _VERSION_PART_RE.match(part)
         if m is not None:
-            part = re.sub(r"\d+", "#", part)
+            part = _DIGITS_RE.sub("#", part)
         new_parts.append(part)
     return "-".join(new_parts)
 
@@ -34,26 +40,25 @@ def main():
 SELECT nix_name, cast(duration as int)
 FROM build
 {args.where}
-ORDER BY nix_name
 """
     )
+    cur.arraysize = 10_000
 
     #
     # Record both the name of the package and the sanitized name of the package
     # where 'sanitization' removes numbers, so that 'adoptopenjdk-hotspot-bin-15.0.1'
     # becomes 'adoptopenjdk-hotspot-bin-#.#.#'
     #
-    sanitized = []
-    for nix_name, value in cur:
-        sname = deversion_nix_drv_name(nix_name)
-
-        sanitized.append((nix_name, value))
-        sanitized.append((sname, value))
+    buckets: DefaultDict[str, List[int]] = defaultdict(list)
+    while rows := cur.fetchmany():
+        for nix_name, value in rows:
+            buckets[nix_name].append(value)
+            buckets[deversion_nix_drv_name(nix_name)].append(value)
 
-    medians = []
-    for nix_name, group in itertools.groupby(sorted(sanitized), lambda x: x[0]):
-        median = int(statistics.median([g[1] for g in group]))
-        medians.append((nix_name, median))
+    medians = sorted(
+        (nix_name, int(statistics.median(values)))
+        for nix_name, values in buckets.items()
+    )
 
     # pyfst.write raises an error if they're not unique + sorted
     assert len(medians) == len({n for n, _ in medians})
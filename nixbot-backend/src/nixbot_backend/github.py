@@ -1,12 +1,46 @@
 from __future__ import annotations
 
-import json
+import codecs
+import re
 import urllib.error
 import urllib.parse
 import urllib.request
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
+import requests
+from requests.adapters import HTTPAdapter
 from unidiff import PatchSet
+from urllib3.util.retry import Retry
+
+
+PULL_REQUEST_AND_COMMENTS_QUERY = """
+query($number: Int!) {
+  repository(owner: "NixOS", name: "nixpkgs") {
+    pullRequest(number: $number) {
+      state
+      body
+      author { login }
+      comments(first: 100) {
+        nodes {
+          body
+          author { login }
+        }
+      }
+    }
+  }
+}
+"""
+
+_QUOTED_DIFF_GIT_HEADER_RE = re.compile(rb'^("(?:[^"\\]|\\.)*") ("(?:[^"\\]|\\.)*")$')
+# Lines in a file's extended header that name it, and the prefix on the name
+_DIFF_FILE_NAME_LINES = (
+    (b"--- ", b"a/"),
+    (b"+++ ", b"b/"),
+    (b"rename from ", b""),
+    (b"rename to ", b""),
+    (b"copy from ", b""),
+    (b"copy to ", b""),
+)
 
 
 def pr_url(pr: int) -> str:
@@ -17,24 +51,33 @@ class GithubClient:
     def __init__(self, api_token: Optional[str]) -> None:
         self.api_token = api_token
 
+        # Keep connections to api.github.com alive between requests
+        self._session = requests.Session()
+        self._session.headers.update(
+            {
+                "Content-Type": "application/json",
+                "Accept": "application/vnd.github.v3+json",
+            }
+        )
+        if self.api_token:
+            self._session.headers["Authorization"] = f"token {self.api_token}"
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=10,
+            max_retries=Retry(
+                total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]
+            ),
+        )
+        self._session.mount("https://", adapter)
+
     def _request(
         self, path: str, method: str, data: Optional[Dict[str, Any]] = None
     ) -> Any:
         url = urllib.parse.urljoin("https://api.github.com/", path)
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/vnd.github.v3+json",
-        }
-        if self.api_token:
-            headers["Authorization"] = f"token {self.api_token}"
 
-        body = None
-        if data:
-            body = json.dumps(data).encode("ascii")
-
-        req = urllib.request.Request(url, headers=headers, method=method, data=body)
-        resp = urllib.request.urlopen(req)
-        return json.loads(resp.read())
+        resp = self._session.request(method, url, json=data or None)
+        resp.raise_for_status()
+        return resp.json()
 
     def get(self, path: str) -> Any:
         return self._request(path, "GET")
@@ -53,6 +96,36 @@ class GithubClient:
     def graphql(self, query: str, variables: Dict[str, Any]) -> Any:
         return self.post("graphql", data={"query": query, "variables": variables})
 
+    def pull_request_and_comments(self, number: int) -> Tuple[Any, List[Any]]:
+        """Get a pull request and the comments on it in one request. These
+        are returned in the same shape as pull_request() and
+        pull_request_comments(), restricted to the fields we look at.
+        """
+        if not self.api_token:
+            # The graphql api doesn't allow anonymous access
+            return self.pull_request(number), self.pull_request_comments(number)
+
+        resp = self.graphql(PULL_REQUEST_AND_COMMENTS_QUERY, {"number": number})
+        if "errors" in resp:
+            raise RuntimeError(resp["errors"])
+        pr = resp["data"]["repository"]["pullRequest"]
+
+        def user(node: Dict[str, Any]) -> Dict[str, Any]:
+            # author is null for deleted accounts, which the rest api
+            # reports as being the user "ghost"
+            return {"login": node["author"]["login"] if node["author"] else "ghost"}
+
+        pr_data = {
+            # graphql has OPEN / CLOSED / MERGED, the rest api has open / closed
+            "state": "open" if pr["state"] == "OPEN" else "closed",
+            "body": pr["body"],
+            "user": user(pr),
+        }
+        comments = [
+            {"body": c["body"], "user": user(c)} for c in pr["comments"]["nodes"]
+        ]
+        return pr_data, comments
+
     def load_patchset(self, number: int) -> PatchSet:
         "Get a pull request patchset"
         diff = urllib.request.urlopen(
@@ -62,6 +135,80 @@ class GithubClient:
         patch = PatchSet(diff, encoding=encoding)
         return patch
 
+    def modified_files(self, number: int) -> List[str]:
+        """Get the files touched by a pull request. Like
+        determine_modified_files(load_patchset(number)), but it streams the
+        diff and only reads the file headers instead of parsing every hunk.
+        """
+        diff = urllib.request.urlopen(
+            f"https://github.com/NixOS/nixpkgs/pull/{number}.diff"
+        )
+        encoding = diff.headers.get_charsets()[0] or "utf-8"
+        return modified_files_in_diff(diff, encoding)
+
+
+def _unquote_diff_path(path: bytes) -> bytes:
+    # git puts a tab after names with spaces in them, and C-quotes names
+    # with unusual characters, e.g. "a/caf\303\251"
+    path = path.split(b"\t")[0]
+    if path.startswith(b'"') and path.endswith(b'"'):
+        return codecs.escape_decode(path[1:-1])[0]  # type: ignore
+    return path
+
+
+def _diff_git_header_paths(line: bytes) -> List[bytes]:
+    # `diff --git a/X b/Y`. Only used for files without ---/+++ or rename
+    # lines (binary files, mode changes), where X and Y are the same.
+    rest = line[len(b"diff --git ") :]
+    m = _QUOTED_DIFF_GIT_HEADER_RE.match(rest)
+    if m is not None:
+        source, target = (_unquote_diff_path(p) for p in m.groups())
+    else:
+        n = (len(rest) - 1) // 2
+        if rest[n : n + 1] == b" " and rest[2:n] == rest[n + 3 :]:
+            source, target = rest[:n], rest[n + 1 :]
+        else:
+            source, _, target = rest.partition(b" b/")
+            target = b"b/" + target
+    return [source[len(b"a/") :], target[len(b"b/") :]]
+
+
+def modified_files_in_diff(lines: Iterable[bytes], encoding: str = "utf-8") -> List[str]:
+    """The files touched by a git diff: the source and target path of every
+    file in it, including binary files, pure renames and mode changes. Only
+    the headers of each file are looked at; everything from its first hunk to
+    the next `diff --git` line is skipped.
+    """
+    filenames: Set[bytes] = set()
+    # The current file's `diff --git` line, until another line names it
+    header: Optional[bytes] = None
+    in_header = False
+    for line in lines:
+        line = line.rstrip(b"\n")
+        if line.startswith(b"diff --git "):
+            if header is not None:
+                filenames.update(_diff_git_header_paths(header))
+            header = line
+            in_header = True
+            continue
+        if not in_header:
+            continue
+        if line.startswith(b"@@ "):
+            in_header = False
+            continue
+
+        for prefix, path_prefix in _DIFF_FILE_NAME_LINES:
+            if line.startswith(prefix):
+                path = _unquote_diff_path(line[len(prefix) :])
+                if path != b"/dev/null" and path.startswith(path_prefix):
+                    filenames.add(path[len(path_prefix) :])
+                header = None
+                break
+
+    if header is not None:
+        filenames.update(_diff_git_header_paths(header))
+    return sorted(f.decode(encoding) for f in filenames)
+
 
 def determine_modified_files(patchset: PatchSet) -> List[str]:
     filenames = set()
@@ -1,5 +1,5 @@
 # https://github.com/networkx/networkx/blob/777e57a5f08736a9e2b5aa6c87ff38cb8729c926/networkx/algorithms/dag.py
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import networkx as nx
 
@@ -45,17 +45,20 @@ def dag_longest_paths(
     if topo_order is None:
         topo_order = nx.topological_sort(G)
 
-    dist: Dict[str, Tuple[int, str]] = {}  # stores {v : (length, u)}
+    # One pass in topological order, with a plain loop over the predecessors
+    # instead of building a list of candidates for max() per node.
+    pred = G.pred
+    dist: Dict[str, Tuple[float, str]] = {}  # stores {v : (length, u)}
     for v in topo_order:
-        us = [
-            (dist[u][0] + data.get(weight, default_weight), u)
-            for u, data in G.pred[v].items()
-        ]
+        best: Optional[Tuple[float, str]] = None
+        for u, data in pred[v].items():
+            length = dist[u][0] + data.get(weight, default_weight)
+            if best is None or length > best[0]:
+                best = (length, u)
 
         # Use the best predecessor if there is one and its distance is
         # non-negative, otherwise terminate.
-        maxu = max(us, key=lambda x: x[0]) if us else (0, v)
-        dist[v] = maxu if maxu[0] >= 0 else (0, v)
+        dist[v] = best if best is not None and best[0] >= 0 else (0, v)
 
     paths = []
     for v in _all_maxes(dist, key=lambda x: dist[x][0]):
@@ -1,19 +1,19 @@
 from __future__ import annotations
 
+import bisect
 import functools
-import io
 import os
-import statistics
+import re
 import subprocess
 import time
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 from datetime import timedelta
+from itertools import islice
 from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
 
 import networkx as nx
 import pyfst
 from loguru import logger as log
-from nixbot_common import removeprefix
 from statx import stat, stat_result
 from typing_extensions import TypedDict
 
@@ -21,6 +21,76 @@ from .compile_fst import deversion_nix_drv_name
 
 T = TypeVar("T")
 
+# Drvs whose names end in one of these are assumed to take no time to build
+_SKIP_SUFFIXES = (
+    "-config",
+    "-env",
+    "-fhs",
+    "-hook",
+    "-etc",
+    "-init",
+    "-info",
+    "-lib",
+    "-list",
+    "-lockfile",
+    "-merged",
+    "-multi",
+    "-paths",
+    "-params",
+    "-patched",
+    "-runtime",
+    "-sources",
+    "-target",
+    "-wrapped",
+    "-wrapper-",
+    ".7z",
+    ".cfg",
+    ".cmake",
+    ".conf",
+    ".d",
+    ".deb",
+    ".desktop",
+    ".diff",
+    ".fish",
+    ".gem",
+    ".ini",
+    ".h",
+    ".jar",
+    ".js",
+    ".json",
+    ".nix",
+    ".p",
+    ".patch",
+    ".pl",
+    ".png",
+    ".properties",
+    ".rpm",
+    ".rules",
+    ".run",
+    ".sed",
+    ".sh",
+    ".tar.bz2",
+    ".tar.gz",
+    ".tar.xz",
+    ".tgz",
+    ".toml",
+    ".whl",
+    ".zip",
+    "bash",
+    "bazel-deps",
+    "bazel-rc",
+    "chrootenv",
+    "ldconfig",
+    "ghostscript-fonts",
+    "go-bootstrap",
+    "offline",
+    "profile",
+    "remote_java_tools_linux",
+    "source",
+    "steam",
+    "x11env",
+)
+
 
 ReportJson = TypedDict("ReportJson", {
     "blacklisted": List[str],
@@ -63,7 +133,7 @@ class Attr:
         return hash((self.name, self.drv_path, self.path))
 
     def to_dict(self) -> Dict[str, Any]:
-        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+        return {k: getattr(self, k) for k in _ATTR_PUBLIC_KEYS}
 
     def filename(self) -> Optional[str]:
         if self.position is not None:
@@ -71,21 +141,19 @@ class Attr:
         return None
 
 
+_ATTR_PUBLIC_KEYS = tuple(f.name for f in fields(Attr) if not f.name.startswith("_"))
+
+
 def get_build_time(drv_path: str) -> Optional[timedelta]:
-    def get_log_path(drv_path: str) -> Optional[str]:
-        if drv_path is None:
-            return None
-        base = os.path.basename(drv_path)
-        prefix = "/nix/var/log/nix/drvs/"
-        full = os.path.join(prefix, base[:2], base[2:] + ".bz2")
-        if os.path.exists(full):
-            return full
+    if drv_path is None:
         return None
-
-    log_path = get_log_path(drv_path)
-    if log_path is None:
+    base = os.path.basename(drv_path)
+    full = os.path.join("/nix/var/log/nix/drvs/", base[:2], base[2:] + ".bz2")
+    # One statx, instead of an exists() check followed by a statx
+    try:
+        result = stat(full)
+    except OSError:
         return None
-    result = stat(log_path)
     assert isinstance(result, stat_result)
     return timedelta(microseconds=(result.st_mtime_ns - result.st_birthtime_ns) / 1000)
 
@@ -102,37 +170,41 @@ def get_build_graph(
     if len(targets) == 0:
         return nx.DiGraph()
 
+    PFX = "/nix/store/"
+
     def graph_ml_chunks():
         # Work around `OSError: [Errno 7] Argument list too long: 'nix-store'`
         # by chunking.
         for chunk in _chunker(targets, 5000):
-            graph_ml = subprocess.run(
-                ["nix-store", "--query", "--graphml"] + chunk, stdout=subprocess.PIPE
-            )
-            yield nx.read_graphml(io.BytesIO(graph_ml.stdout))
-
-    g = nx.compose_all(graph_ml_chunks())
-
-    # At this point, the nodes to not have /nix/store in their names
-    # And it includes _everything_, down to glibc
-
-    PFX = "/nix/store/"
-
+            cmd = ["nix-store", "--query", "--graphml"] + chunk
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 20) as p:
+                # Parse straight off the pipe, while nix-store is still writing.
+                # nix-store emits node ids without the /nix/store/ prefix, so add it
+                # while parsing rather than relabeling the whole graph afterwards.
+                chunk_graph = nx.read_graphml(p.stdout, node_type=lambda n: f"{PFX}{n}")
+            if p.returncode != 0:
+                raise subprocess.CalledProcessError(p.returncode, cmd)
+            yield chunk_graph
+
+    # Merge every chunk into the first one in place, rather than composing
+    # fresh copies of the (mostly overlapping) graphs.
+    chunks = graph_ml_chunks()
+    g = next(chunks)
+    for chunk_graph in chunks:
+        g.update(edges=chunk_graph.edges(data=True), nodes=chunk_graph.nodes(data=True))
+
+    # At this point, the graph includes _everything_, down to glibc
     if drvpath_universe is not None:
-        to_remove = set(g.nodes) - {
-            removeprefix(drv_path, PFX) for drv_path in drvpath_universe
-        }
-        to_remove -= {removeprefix(t, PFX) for t in targets}
-        g.remove_nodes_from(to_remove)
-
-    nx.relabel_nodes(g, {n: f"{PFX}{n}" for n in g.nodes}, copy=False)
+        keep = {d if d.startswith(PFX) else f"{PFX}{d}" for d in drvpath_universe}
+        keep.update(t if t.startswith(PFX) else f"{PFX}{t}" for t in targets)
+        g.remove_nodes_from([n for n in g.nodes if n not in keep])
 
     if time.time() - start_time > 2:
         log.info(f"Computing build graph: {time.time() - start_time:.2f} sec")
     return g
 
 
-@functools.lru_cache()
+@functools.lru_cache(maxsize=None)
 def current_system() -> str:
     system = subprocess.run(
         [
@@ -149,7 +221,15 @@ def current_system() -> str:
         stdout=subprocess.PIPE,
         text=True,
     )
-    return system.stdout
+    return system.stdout.strip()
+
+
+_DRY_RUN_HEADER_RE = re.compile(
+    r"(?P<fetch>will be fetched)"
+    r"|(?P<build>will be built)"
+    r"|(?P<ignore>don't know how to build|querying info about|warning: unable to download"
+    r"|downloading.*\.narinfo|\.narinfo.*downloading)"
+)
 
 
 def build_dry(
@@ -172,31 +252,35 @@ def build_dry(
     )
     end = time.time()
 
-    lines = result.stderr.splitlines()
+    if end - start > 2:
+        log.info(f"Computing nix build --dry-run: {end-start:.2f} sec")
+
+    return parse_dry_run(result.stderr)
+
+
+def parse_dry_run(stderr: str) -> Tuple[Set[str], Set[str]]:
+    """Parse the stderr of `nix-store --realize --dry-run` into the drvs to
+    be built and the paths to be fetched"""
     to_fetch: List[str] = []
     to_build: List[str] = []
     ignore: List[str] = []
-    for line in lines:
+    # Store paths before any header aren't something we have to realize
+    cur: List[str] = ignore
+    for line in stderr.splitlines():
         line = line.strip()
-        if "will be fetched" in line:
+        if line.startswith("/nix/store"):
+            cur.append(line)
+            continue
+        m = _DRY_RUN_HEADER_RE.search(line)
+        if m is None:
+            if line != "":
+                raise RuntimeError(f"dry-run parsing failed: '{line}'. lines={stderr}")
+        elif m.lastgroup == "fetch":
             cur = to_fetch
-        elif "will be built" in line:
+        elif m.lastgroup == "build":
             cur = to_build
-        elif "don't know how to build" in line:
-            cur = ignore
-        elif "querying info about" in line:
-            cur = ignore
-        elif "downloading" in line and ".narinfo" in line:
+        else:
             cur = ignore
-        elif "warning: unable to download" in line:
-            cur = ignore
-        elif line.startswith("/nix/store"):
-            cur.append(line)
-        elif line != "":
-            raise RuntimeError(f"dry-run parsing failed: '{line}'. lines={result.stderr}")
-
-    if end - start > 2:
-        log.info(f"Computing nix build --dry-run: {end-start:.2f} sec")
 
     return set(to_build), set(to_fetch)
 
@@ -205,10 +289,6 @@ def get_estimated_build_times(drv_paths: List[str]) -> Dict[str, float]:
     NUM_MISSING_BUILD_PRINTS_CUTOFF = 50
 
     start_time = time.time()
-    db = pyfst.load(os.path.join(os.path.dirname(__file__), "build-times.fst"))
-
-    def get_drv_name(drv_path: str) -> str:
-        return drv_path.split("-", 1)[1][:-4]
 
     def impl():
         num_missing_build_prints = 0
@@ -217,77 +297,7 @@ def get_estimated_build_times(drv_paths: List[str]) -> Dict[str, float]:
             name = get_drv_name(drv_path)
             sname = deversion_nix_drv_name(name)
 
-            if any(
-                name.endswith(suffix)
-                for suffix in [
-                    "-config",
-                    "-env",
-                    "-fhs",
-                    "-hook",
-                    "-etc",
-                    "-init",
-                    "-info",
-                    "-lib",
-                    "-list",
-                    "-lockfile",
-                    "-merged",
-                    "-multi",
-                    "-paths",
-                    "-params",
-                    "-patched",
-                    "-runtime",
-                    "-sources",
-                    "-target",
-                    "-wrapped",
-                    "-wrapper-",
-                    ".7z",
-                    ".cfg",
-                    ".cmake",
-                    ".conf",
-                    ".d",
-                    ".deb",
-                    ".desktop",
-                    ".diff",
-                    ".fish",
-                    ".gem",
-                    ".ini",
-                    ".h",
-                    ".jar",
-                    ".js",
-                    ".json",
-                    ".nix",
-                    ".p",
-                    ".patch",
-                    ".pl",
-                    ".png",
-                    ".properties",
-                    ".rpm",
-                    ".rules",
-                    ".run",
-                    ".sed",
-                    ".sh",
-                    ".tar.bz2",
-                    ".tar.gz",
-                    ".tar.xz",
-                    ".tgz",
-                    ".toml",
-                    ".whl",
-                    ".zip",
-                    "bash",
-                    "bazel-deps",
-                    "bazel-rc",
-                    "chrootenv",
-                    "ldconfig",
-                    "ghostscript-fonts",
-                    "go-bootstrap",
-                    "offline",
-                    "profile",
-                    "remote_java_tools_linux",
-                    "source",
-                    "steam",
-                    "x11env",
-                ]
-            ):
+            if name.endswith(_SKIP_SUFFIXES):
                 yield (drv_path, 0)
                 continue
 
@@ -298,12 +308,9 @@ def get_estimated_build_times(drv_paths: List[str]) -> Dict[str, float]:
                 (sname, 0),
                 (sname, 1),
             ):
-                try:
-                    rs = db.fuzzy(q, distance)
-                except OSError:
-                    rs = []
+                rs = _build_times_fuzzy(q, distance)
                 if len(rs) > 0:
-                    yield (drv_path, statistics.median([r[1] for r in rs]))
+                    yield (drv_path, _median([r[1] for r in rs]))
                     found = True
                     break
 
@@ -313,9 +320,9 @@ def get_estimated_build_times(drv_paths: List[str]) -> Dict[str, float]:
             name_parts = name.split("-")
             if len(name_parts) > 0:
                 for i in range(len(name_parts) - 1, 0, -1):
-                    rs = db.prefix("-".join(name_parts[:i]))
+                    rs = _build_times_prefix("-".join(name_parts[:i]))
                     if len(rs) > 0:
-                        value = statistics.median([r[1] for r in rs])
+                        value = _median([r[1] for r in rs])
                         if num_missing_build_prints < NUM_MISSING_BUILD_PRINTS_CUTOFF:
                             log.info(
                                 f"Build-time estimate for {name} fell back to {'-'.join(name_parts[:i])}",
@@ -347,18 +354,73 @@ def get_estimated_build_times(drv_paths: List[str]) -> Dict[str, float]:
     return {k: v or 0 for k, v in data.items()}
 
 
-def _chunker(seq: Iterable[T], size: int) -> Iterable[List[T]]:
-    res = []
-    for el in seq:
-        res.append(el)
-        if len(res) == size:
-            yield res
-            res = []
-    if res:
-        yield res
+@functools.lru_cache(maxsize=None)
+def get_drv_name(drv_path: str) -> str:
+    return drv_path.split("-", 1)[1][:-4]
 
 
 @functools.lru_cache()
+def _build_times_db() -> Any:
+    return pyfst.load(os.path.join(os.path.dirname(__file__), "build-times.fst"))
+
+
+@functools.lru_cache()
+def _build_times_index() -> Tuple[List[str], List[Tuple[str, int]]]:
+    # One ordered pass over the whole FST; exact and prefix lookups then
+    # become bisections into the sorted key list instead of FST traversals.
+    items = _build_times_db().prefix("")
+    return [k for k, _ in items], items
+
+
+@functools.lru_cache(maxsize=None)
+def _build_times_fuzzy(q: str, distance: int) -> List[Tuple[str, int]]:
+    if distance == 0:
+        keys, items = _build_times_index()
+        i = bisect.bisect_left(keys, q)
+        return items[i : i + 1] if i < len(keys) and keys[i] == q else []
+    try:
+        return _build_times_db().fuzzy(q, distance)
+    except OSError:
+        return []
+
+
+@functools.lru_cache(maxsize=None)
+def _build_times_prefix(prefix: str) -> List[Tuple[str, int]]:
+    keys, items = _build_times_index()
+    lo = bisect.bisect_left(keys, prefix)
+    hi = lo
+    while hi < len(keys) and keys[hi].startswith(prefix):
+        hi += 1
+    return items[lo:hi]
+
+
+def _median(vals: List[int]) -> float:
+    # statistics.median, specialized for the short lists the FST lookups return
+    n = len(vals)
+    if n == 1:
+        return vals[0]
+    if n == 2:
+        return (vals[0] + vals[1]) / 2
+    if n == 3:
+        a, b, c = vals
+        return max(min(a, b), min(max(a, b), c))
+    vals = sorted(vals)
+    if n % 2 == 1:
+        return vals[n // 2]
+    return (vals[n // 2 - 1] + vals[n // 2]) / 2
+
+
+def _chunker(seq: Iterable[T], size: int) -> Iterable[List[T]]:
+    if isinstance(seq, list):
+        for i in range(0, len(seq), size):
+            yield seq[i : i + size]
+        return
+    it = iter(seq)
+    while chunk := list(islice(it, size)):
+        yield chunk
+
+
+@functools.lru_cache(maxsize=None)
 def _get_nixpkgs() -> str:
     for section in os.environ["NIX_PATH"].split(":"):
         key, value = section.split("=")
@@ -1,10 +1,10 @@
-import json
 import os
 import subprocess
 from functools import lru_cache
-from itertools import islice
-from typing import Any, Dict, List, Optional, Tuple
+from itertools import filterfalse, islice
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
 
+import orjson
 from loguru import logger as log
 
 # https://github.com/rmcgibbo/nixpkgs-review-bot/issues/68
@@ -21,7 +21,7 @@ IGNORE_SUGGESTIONS_FOR_FILES = {
 # https://github.com/jtojnar/nixpkgs-hammering/issues/77#issuecomment-786193493
 # https://github.com/jtojnar/nixpkgs-hammering/pull/78#pullrequestreview-599072677
 # https://github.com/jtojnar/nixpkgs-hammering/issues/73#issuecomment-817819413
-ATTRS_THAT_BREAK_NIXPKGS_HAMMER = {
+ATTRS_THAT_BREAK_NIXPKGS_HAMMER: FrozenSet[str] = frozenset({
     "acl",
     "attr",
     "bash",
@@ -48,10 +48,10 @@ ATTRS_THAT_BREAK_NIXPKGS_HAMMER = {
     "javaPackages.mavenHello_1_1",
     "libgccjit",
     "zfsbackup",
-}
+})
 
 
-@lru_cache()
+@lru_cache(maxsize=None)
 def _get_nixpkgs() -> str:
     assert os.path.exists("nixpkgs")
     return "nixpkgs"
@@ -65,7 +65,7 @@ def nixpkgs_hammer(attrs: List[str]) -> Tuple[Optional[str], int]:
     the set of files modified by the pr, which should be passed in `modified_files`.
     """
 
-    attrs_to_hammer = [a for a in attrs if a not in ATTRS_THAT_BREAK_NIXPKGS_HAMMER]
+    attrs_to_hammer = list(filterfalse(ATTRS_THAT_BREAK_NIXPKGS_HAMMER.__contains__, attrs))
     if len(attrs_to_hammer) == 0:
         return None, 0
 
@@ -98,32 +98,39 @@ def nixpkgs_hammer(attrs: List[str]) -> Tuple[Optional[str], int]:
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             check=True,
-            text=True,
             env=env,
         )
     except subprocess.CalledProcessError as e:
         log.error("nixpkgs-hammer crashed")
         log.error(os.path.abspath(os.getcwd()))
-        log.error(e.stderr)
-        log.error(e.stderr)
+        log.error(e.stderr.decode(errors="replace"))
+        log.error(e.stderr.decode(errors="replace"))
         log.error(e.returncode)
         return None, 0
 
-    hammer_report = json.loads(proc.stdout)
+    hammer_report = orjson.loads(proc.stdout)
 
     #
     # Replace `file` with relative path -- should upstream this into
-    # nixpkgs-hammering
+    # nixpkgs-hammering -- in the same pass that picks the messages to report.
     #
-    for name, data in hammer_report.items():
-        for msg in data:
-            for location in msg.get("locations", []):
-                if "file" in location and isinstance(location["file"], str):
-                    location["file"] = os.path.relpath(location["file"], _get_nixpkgs())
+    nixpkgs = _get_nixpkgs()
+    nixpkgs_prefix = os.path.abspath(nixpkgs) + os.sep
+
+    def relativize_locations(msg: Dict[str, Any]) -> Dict[str, Any]:
+        for location in msg.get("locations", []):
+            file = location.get("file")
+            if isinstance(file, str):
+                if file.startswith(nixpkgs_prefix):
+                    location["file"] = file[len(nixpkgs_prefix):]
+                else:
+                    location["file"] = os.path.relpath(file, nixpkgs)
+        return msg
 
     check_reports = set()
     for name, data in hammer_report.items():
-        for msg in islice((m for m in data if is_acceptable_hammer_message(m)), MAX_SUGGESTIONS_PER_PACKAGE):
+        messages = (m for m in map(relativize_locations, data) if is_acceptable_hammer_message(m))
+        for msg in islice(messages, MAX_SUGGESTIONS_PER_PACKAGE):
             check_reports.add(stringify_message(**msg))
 
     if len(check_reports) == 0:
@@ -147,21 +154,19 @@ def html_check_reports(check_reports: List[str]) -> str:
 def stringify_location(file: str, line: int, column: Optional[int]):
     if column is None:
         column = 0
-    with open(os.path.join(_get_nixpkgs(), file), "r") as opened_file:
-        all_lines = opened_file.read().splitlines()
-        line_contents = all_lines[line - 1]
-        line_spaces = " " * len(str(line))
-        pointer = " " * (column - 1) + "^"
-
-        location_lines = [
-            "Near " + file + ":" + str(line) + ":" + str(column) + ":",
-            "```",
-            line_spaces + " |",
-            str(line) + " | " + line_contents,
-            line_spaces + " | " + pointer,
-            "```",
-            "",
-        ]
+    line_contents = _get_line(file, line)
+    line_spaces = " " * len(str(line))
+    pointer = " " * (column - 1) + "^"
+
+    location_lines = [
+        "Near " + file + ":" + str(line) + ":" + str(column) + ":",
+        "```",
+        line_spaces + " |",
+        str(line) + " | " + line_contents,
+        line_spaces + " | " + pointer,
+        "```",
+        "",
+    ]
 
     return "\n".join(location_lines)
 
@@ -204,13 +209,25 @@ def is_ignored_file(msg: Dict[str, Any]) -> bool:
 
 
 def is_ignored_golang_buildFlagsArray_msg(msg: Dict[str, Any]) -> bool:
-    for loc in msg["locations"]:
-        is_golang = False
-        with open(os.path.join(_get_nixpkgs(), loc["file"])) as f:
-            content = f.read()
-            is_golang = "buildGoModule" in content or "buildGoPackage" in content
+    if msg["name"] != "no-flags-array":
+        return False
+    return any(_is_golang_file(loc["file"]) for loc in msg["locations"])
+
+
+@lru_cache(maxsize=4096)
+def _is_golang_file(file: str) -> bool:
+    content = _read_file(file)
+    return b"buildGoModule" in content or b"buildGoPackage" in content
+
+
+@lru_cache(maxsize=256)
+def _get_line(file: str, line: int) -> str:
+    return _read_file(file).splitlines()[line - 1].decode()
 
-        if is_golang and msg["name"] == "no-flags-array":
-            return True
 
-    return False
+@lru_cache(maxsize=64)
+def _read_file(file: str) -> bytes:
+    # Shared by the location formatting and the message filters, which
+    # tend to hit the same handful of files many times per report.
+    with open(os.path.join(_get_nixpkgs(), file), "rb") as f:
+        return f.read()
@@ -1,16 +1,16 @@
 from __future__ import annotations
 
-import json
 import os
 import subprocess
 import time
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
 
+import orjson
 # from loguru import logger as log
 from nixbot_common import configure_logging, isint
 
 from .block_github_comment import is_blocked
-from .github import GithubClient, determine_modified_files
+from .github import GithubClient
 from .nix import ReportJson
 from .nixpkgs_hammer import nixpkgs_hammer
 from .utils import with_distributed_lock
@@ -26,29 +26,31 @@ def main():
     """
     configure_logging()
 
-    with open("report.json") as f:
-        report_json: ReportJson = json.load(f)
+    with open("report.json", "rb") as f:
+        report_json: ReportJson = orjson.loads(f.read())
 
     # Determine which files were patched so that we can post nixpkgs-hammer
     # suggestions only for drvs that are defined in files touched by this PR.
+    # The diff is fetched in the background while changed-attrs.json is read.
     gh = GithubClient(os.environ.get("GITHUB_TOKEN"))
-    modified_files: Optional[List[str]] = None
     assert "PR" in os.environ and isint(os.environ["PR"])
-    patchset = gh.load_patchset(int(os.environ["PR"]))
-    modified_files = determine_modified_files(patchset)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        modified_files_future = executor.submit(gh.modified_files, int(os.environ["PR"]))
 
-    #
-    # Determine which attrs were modified
-    #
-    with open("changed-attrs.json") as f:
-        attrs = json.load(f)
+        #
+        # Determine which attrs were modified
+        #
+        with open("changed-attrs.json", "rb") as f:
+            attrs = orjson.loads(f.read())
+
+        positions = {
+            name: os.path.relpath(v["position"].split(":")[0], "nixpkgs")
+            for name, v in attrs.items()
+            if v["position"] is not None
+        }
+        modified_files = set(modified_files_future.result())
 
-    modified_attrs = []
-    for name, v in attrs.items():
-        if v["position"] is not None:
-            position = os.path.relpath(v["position"].split(":")[0], "nixpkgs")
-            if position in modified_files:
-                modified_attrs.append(name)
+    modified_attrs = [name for name, position in positions.items() if position in modified_files]
 
     #
     # Run hammering, and append it to report.md
@@ -86,5 +88,5 @@ def main():
 
     # Embellish report with some more information, so that we can upload to postgres
     report_json["uploaded"] = uploaded
-    with open("report.json", "w") as f:
-        json.dump(report_json, f)
+    with open("report.json", "wb") as f:
+        f.write(orjson.dumps(report_json))
@@ -19,7 +19,7 @@ from loguru import logger as log
 from nixbot_common import configure_logging, isint
 from precedenceConstrainedKnapsack import precedenceConstrainedKnapsack
 
-from .github import GithubClient, determine_modified_files
+from .github import GithubClient
 from .graphtheory import dag_longest_paths
 from .nix import Attr, build_dry, get_build_graph, get_estimated_build_times
 
@@ -508,8 +508,7 @@ def main():
     # Determine which files were patched so that we can post nixpkgs-hammer
     # suggestions only for drvs that are defined in files touched by this PR.
     if "NIXPKGS_REVIEW_PR" in os.environ and isint(os.environ["NIXPKGS_REVIEW_PR"]):
-        patchset = gh.load_patchset(int(os.environ["NIXPKGS_REVIEW_PR"]))
-        modified_files = determine_modified_files(patchset)
+        modified_files = gh.modified_files(int(os.environ["NIXPKGS_REVIEW_PR"]))
     else:
         modified_files = []
 
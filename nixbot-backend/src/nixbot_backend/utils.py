@@ -1,18 +1,22 @@
 from contextlib import contextmanager
-from typing import Any, Dict, Iterable
+from typing import Any, Dict, Iterable, List, Union
 
 from systemd import journal as journald
 
 
 def journald_logs_since(
-    match: Dict[str, str], start_time: float
+    match: Dict[str, Union[str, List[str]]], start_time: float
 ) -> Iterable[Dict[str, Any]]:
     journal = journald.Reader()
-    journal.add_match(**match)
-    journal.seek_tail()
-
+    for key, values in match.items():
+        for value in [values] if isinstance(values, str) else values:
+            # journald ORs together matches on the same field
+            journal.add_match(**{key: value})
+    # Let journald skip debug entries and earlier boots rather than
+    # decoding them for us to discard.
+    journal.this_boot()
+    journal.log_level(journald.LOG_INFO)
     journal.seek_realtime(start_time)
-    journal.get_previous()
     return journal
 
 
@@ -0,0 +1,99 @@
+from nixbot_backend.github import modified_files_in_diff
+
+
+def lines(diff: str):
+    return [line.encode() for line in diff.splitlines(keepends=True)]
+
+
+def test_modified_files_in_diff_edit():
+    diff = """\
+diff --git a/pkgs/foo/default.nix b/pkgs/foo/default.nix
+index 34fe065..ac3860e 100644
+--- a/pkgs/foo/default.nix
++++ b/pkgs/foo/default.nix
+@@ -1,2 +1,3 @@
+-x
++y
+ -- a/not-a-file
++++ b/not-a-file
+"""
+    assert modified_files_in_diff(lines(diff)) == ["pkgs/foo/default.nix"]
+
+
+def test_modified_files_in_diff_new_and_deleted():
+    diff = """\
+diff --git a/new.nix b/new.nix
+new file mode 100644
+index 0000000..b26b2ef
+--- /dev/null
++++ b/new.nix
+@@ -0,0 +1 @@
++new
+diff --git a/gone.nix b/gone.nix
+deleted file mode 100644
+index abaddc0..0000000
+--- a/gone.nix
++++ /dev/null
+@@ -1 +0,0 @@
+-del
+"""
+    assert modified_files_in_diff(lines(diff)) == ["gone.nix", "new.nix"]
+
+
+def test_modified_files_in_diff_binary():
+    diff = """\
+diff --git a/img.png b/img.png
+index 88768ef..f68ed80 100644
+Binary files a/img.png and b/img.png differ
+diff --git a/new.bin b/new.bin
+new file mode 100644
+index 0000000..0ae8040
+Binary files /dev/null and b/new.bin differ
+"""
+    assert modified_files_in_diff(lines(diff)) == ["img.png", "new.bin"]
+
+
+def test_modified_files_in_diff_rename():
+    diff = """\
+diff --git a/old.nix b/new.nix
+similarity index 100%
+rename from old.nix
+rename to new.nix
+diff --git a/with b space.nix b/moved b x.nix
+similarity index 100%
+rename from with b space.nix
+rename to moved b x.nix
+"""
+    assert modified_files_in_diff(lines(diff)) == [
+        "moved b x.nix",
+        "new.nix",
+        "old.nix",
+        "with b space.nix",
+    ]
+
+
+def test_modified_files_in_diff_mode_change():
+    diff = """\
+diff --git a/build.sh b/build.sh
+old mode 100644
+new mode 100755
+diff --git a/with space.sh b/with space.sh
+old mode 100644
+new mode 100755
+"""
+    assert modified_files_in_diff(lines(diff)) == ["build.sh", "with space.sh"]
+
+
+def test_modified_files_in_diff_quoted():
+    diff = r"""diff --git "a/caf\303\251.nix" "b/caf\303\251.nix"
+index bca70f3..b26b2ef 100644
+--- "a/caf\303\251.nix"
++++ "b/caf\303\251.nix"
+@@ -1 +1 @@
+-q
++qq
+diff --git "a/caf\303\251.sh" "b/caf\303\251.sh"
+old mode 100644
+new mode 100755
+"""
+    assert modified_files_in_diff(lines(diff)) == ["café.nix", "café.sh"]
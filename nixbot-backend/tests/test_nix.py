@@ -0,0 +1,43 @@
+import pytest
+
+from nixbot_backend.nix import parse_dry_run
+
+
+def test_parse_dry_run():
+    stderr = """\
+these derivations will be built:
+  /nix/store/aaaa-foo-1.0.drv
+  /nix/store/bbbb-bar-2.0.drv
+these paths will be fetched (0.10 MiB download, 0.50 MiB unpacked):
+  /nix/store/cccc-baz-3.0
+"""
+    assert parse_dry_run(stderr) == (
+        {"/nix/store/aaaa-foo-1.0.drv", "/nix/store/bbbb-bar-2.0.drv"},
+        {"/nix/store/cccc-baz-3.0"},
+    )
+
+
+def test_parse_dry_run_ignored_sections():
+    stderr = """\
+don't know how to build these paths:
+  /nix/store/dddd-missing-1.0
+these derivations will be built:
+  /nix/store/aaaa-foo-1.0.drv
+warning: unable to download 'https://cache.nixos.org/eeee.narinfo': HTTP error 500
+  /nix/store/eeee-flaky-1.0
+"""
+    assert parse_dry_run(stderr) == ({"/nix/store/aaaa-foo-1.0.drv"}, set())
+
+
+def test_parse_dry_run_store_path_before_any_header():
+    stderr = """\
+/nix/store/ffff-stray-1.0
+these derivations will be built:
+  /nix/store/aaaa-foo-1.0.drv
+"""
+    assert parse_dry_run(stderr) == ({"/nix/store/aaaa-foo-1.0.drv"}, set())
+
+
+def test_parse_dry_run_unknown_line():
+    with pytest.raises(RuntimeError):
+        parse_dry_run("something unexpected\n")
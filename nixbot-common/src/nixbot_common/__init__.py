@@ -12,11 +12,14 @@ from typing import Any, Dict, Optional
 from loguru import logger
 
 
-def removeprefix(s: str, prefix: str, /) -> str:
-    if s.startswith(prefix):
-        return s[len(prefix) :]
-    else:
-        return s[:]
+if sys.version_info >= (3, 9):
+    removeprefix = str.removeprefix
+else:
+
+    def removeprefix(s: str, prefix: str, /) -> str:
+        if s.startswith(prefix):
+            return s[len(prefix) :]
+        return s
 
 
 def format(istty: bool):
@@ -84,11 +87,18 @@ def get_ec2_metadata() -> Optional[Dict[str, Any]]:
     return None
 
 
-def create_nixpkgs_review_dispatched_table_sql() -> str:
-    with open(os.path.join(os.path.dirname(__file__), "nixpkgs_review_dispatched.sql")) as f:
+def _read_sql(filename: str) -> str:
+    with open(os.path.join(os.path.dirname(__file__), filename)) as f:
         return f.read()
 
 
+_CREATE_NIXPKGS_REVIEW_DISPATCHED_TABLE_SQL = _read_sql("nixpkgs_review_dispatched.sql")
+_CREATE_NIXPKGS_REVIEW_FINISHED_TABLE_SQL = _read_sql("nixpkgs_review_finished.sql")
+
+
+def create_nixpkgs_review_dispatched_table_sql() -> str:
+    return _CREATE_NIXPKGS_REVIEW_DISPATCHED_TABLE_SQL
+
+
 def create_nixpkgs_review_finished_table_sql() -> str:
-    with open(os.path.join(os.path.dirname(__file__), "nixpkgs_review_finished.sql")) as f:
-        return f.read()
+    return _CREATE_NIXPKGS_REVIEW_FINISHED_TABLE_SQL
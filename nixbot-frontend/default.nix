@@ -5,6 +5,8 @@
 , aiostream
 , aiohttp
 , cchardet
+, orjson
+, uvloop
 , nixbot-common
 , typing-extensions
 , mypy
@@ -26,6 +28,8 @@ buildPythonApplication {
     propagatedBuildInputs = [
       aiodns
       cchardet
+      orjson
+      uvloop
       aiohttp
       aiostream
       asyncpg
@@ -42,8 +46,8 @@ buildPythonApplication {
     ];
 
     checkPhase = ''
-      # echo -e "\x1b[32m## run unittest\x1b[0m"
-      # py.test .
+      echo -e "\x1b[32m## run unittest\x1b[0m"
+      py.test tests/
       echo -e "\x1b[32m## run isort\x1b[0m"
       isort -df -rc --lines 999 src/
       echo -e "\x1b[32m## run black\x1b[0m"
@@ -6,18 +6,27 @@ import json
 import os
 from datetime import datetime
 from functools import partial
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
 
-import aiohttp
-import asyncpg
-import boto3
+import uvloop
 from aiostream import stream
 from loguru import logger as log
 from nixbot_common import configure_logging, create_nixpkgs_review_dispatched_table_sql
 
-from .nixpkgs import aiter_nixpkgs_events, event_is_pull_request_opened, get_ofborg_eval, pr_number_as_pull_event
+from .nixpkgs import (
+    PullRequestStatuses,
+    aiter_nixpkgs_events,
+    event_is_pull_request_opened,
+    get_ofborg_eval,
+    gist_session,
+    github_session,
+    pr_number_as_pull_event,
+)
 from .server import aiter_server_events
 
+if TYPE_CHECKING:
+    import asyncpg
+
 SQSQueue = Any
 BUILD_SERVER_ASG = {
     "aarch64-linux": "backend-aarch64",
@@ -29,9 +38,15 @@ SQS_QUEUE_NAMES = {
 }
 assert sorted(BUILD_SERVER_ASG.keys()) == sorted(SQS_QUEUE_NAMES.keys())
 ALL_BUILD_SYSTEMS = set(BUILD_SERVER_ASG.keys())
+# SendMessageBatch takes at most 10 entries
+SQS_MAX_BATCH_SIZE = 10
+SQS_BATCH_DELAY_S = 0.2
 
 
 def get_sqs() -> Dict[str, SQSQueue]:
+    # boto3 is slow to import and unused with --dry
+    import boto3
+
     sqs = boto3.resource("sqs")
     return {
         system: sqs.get_queue_by_name(QueueName=queuename)
@@ -39,7 +54,62 @@ def get_sqs() -> Dict[str, SQSQueue]:
     }
 
 
+class SQSBatcher:
+    """Buffers messages per build system and sends them with `send_messages`,
+    once SQS_MAX_BATCH_SIZE are pending or SQS_BATCH_DELAY_S after the first.
+    """
+
+    def __init__(self, queues: Dict[str, SQSQueue]) -> None:
+        self._queues = queues
+        self._pending: Dict[str, List[Tuple[int, str]]] = {system: [] for system in queues}
+        self._timers: Dict[str, asyncio.Task] = {}
+        self._sends: Set[asyncio.Task] = set()
+
+    def send(self, system: str, pr: int, body: str) -> None:
+        pending = self._pending[system]
+        pending.append((pr, body))
+        if len(pending) >= SQS_MAX_BATCH_SIZE:
+            self._flush(system)
+        elif system not in self._timers:
+            self._timers[system] = asyncio.create_task(self._flush_later(system))
+
+    async def aclose(self) -> None:
+        for system in self._pending:
+            self._flush(system)
+        if self._sends:
+            await asyncio.gather(*self._sends)
+
+    async def _flush_later(self, system: str) -> None:
+        await asyncio.sleep(SQS_BATCH_DELAY_S)
+        self._flush(system)
+
+    def _flush(self, system: str) -> None:
+        timer = self._timers.pop(system, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        batch, self._pending[system] = self._pending[system], []
+        if batch:
+            task = asyncio.create_task(self._send(system, batch))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, system: str, batch: List[Tuple[int, str]]) -> None:
+        entries = [{"Id": str(i), "MessageBody": body} for i, (_, body) in enumerate(batch)]
+        loop = asyncio.get_running_loop()
+        try:
+            sqs_response = await loop.run_in_executor(
+                None, partial(self._queues[system].send_messages, Entries=entries)
+            )
+        except Exception:
+            log.exception("SQS submission failed", prs=[pr for pr, _ in batch], system=system)
+            return
+        for failed in sqs_response.get("Failed", []):
+            log.error("SQS Response", response=failed, pr=batch[int(failed["Id"])][0], system=system)
+
+
 def get_autoscaling():
+    import boto3
+
     client = boto3.client("autoscaling")
     return client
 
@@ -87,70 +157,81 @@ async def aiter_opened_prs(seed_prs, session):
 async def execute(
     seed_prs: List[int], dry: bool = False, database_url: str = None
 ) -> None:
-    session = aiohttp.ClientSession()
+    session = github_session()
     pr_stream = stream.map(
         aiter_opened_prs(seed_prs, session=session),
-        partial(get_ofborg_eval, session=session),
+        partial(
+            get_ofborg_eval,
+            session=session,
+            statuses=PullRequestStatuses(session),
+            gist_session=gist_session(),
+        ),
         ordered=False,
+        # Each task can wait hours for ofborg, so the number of PRs being
+        # tracked concurrently must stay unbounded.
+        task_limit=None,
     )
 
+    sqs_batcher: Optional[SQSBatcher]
     if dry:
-        sqs_queues = None
+        sqs_batcher = None
         autoscaling = None
     else:
-        sqs_queues = get_sqs()
+        sqs_batcher = SQSBatcher(get_sqs())
         autoscaling = get_autoscaling()
         assert database_url is not None
 
     if database_url is not None:
+        import asyncpg
+
         conn = await asyncpg.connect(database_url)
         await conn.execute(create_nixpkgs_review_dispatched_table_sql())
     else:
         conn = None
 
-    log.info("Setup", sqs=sqs_queues, autoscaling=autoscaling, conn=conn)
-    async with pr_stream.stream() as streamer:
-        async for event, ofborg_eval in streamer:
-            pr = event["payload"]["number"]
-            log.info("Main loop", pr=pr)
-
-            if ofborg_eval is None:
-                log.info(
-                    "Ofborg failed or no packages",
-                    pr=pr,
-                    ofborg_eval=ofborg_eval,
-                    failed=True,
-                )
-                # Ofborg failed
-                continue
-
-            log.info("New buildable PR", pr=pr, ofborg_eval=ofborg_eval)
-            await log_buildable_pr(conn, pr=pr, ofborg_eval=ofborg_eval)
-            if sqs_queues is not None:
-                for system in ALL_BUILD_SYSTEMS:
-                    if len(ofborg_eval["packages_per_system"].get(system, set())) == 0:
-                        log.info("Empty pull request", pr=pr, system=system)
-                        continue
-
-                    sqs_response = sqs_queues[system].send_message(
-                        # Message must be shorter than 2048 bytes, so don't pack
-                        # too much stuff in here
-                        MessageBody=json.dumps(
-                            dict(
-                                pr=pr,
-                                ofborg_url=ofborg_eval["url"],
-                            )
-                        )
+    log.info("Setup", sqs=sqs_batcher, autoscaling=autoscaling, conn=conn)
+    try:
+        async with pr_stream.stream() as streamer:
+            async for event, ofborg_eval in streamer:
+                pr = event["payload"]["number"]
+                log.info("Main loop", pr=pr)
+
+                if ofborg_eval is None:
+                    log.info(
+                        "Ofborg failed or no packages",
+                        pr=pr,
+                        ofborg_eval=ofborg_eval,
+                        failed=True,
                     )
-                    if sqs_response["ResponseMetadata"]["HTTPStatusCode"] != 200:
-                        log.error("SQS Response", response=sqs_response, pr=pr)
+                    # Ofborg failed
+                    continue
+
+                log.info("New buildable PR", pr=pr, ofborg_eval=ofborg_eval)
+                await log_buildable_pr(conn, pr=pr, ofborg_eval=ofborg_eval)
+                if sqs_batcher is not None:
+                    for system in ALL_BUILD_SYSTEMS:
+                        if len(ofborg_eval["packages_per_system"].get(system, set())) == 0:
+                            log.info("Empty pull request", pr=pr, system=system)
+                            continue
+
+                        sqs_batcher.send(
+                            system,
+                            pr,
+                            # Message must be shorter than 2048 bytes, so don't pack
+                            # too much stuff in here
+                            json.dumps(
+                                dict(
+                                    pr=pr,
+                                    ofborg_url=ofborg_eval["url"],
+                                )
+                            ),
+                        )
 
-            else:
-                log.info(
-                    "Skipping SQS submission",
-                    pr=pr,
-                    sqs_queues=sqs_queues,
-                )
+                else:
+                    log.info("Skipping SQS submission", pr=pr)
+    finally:
+        if sqs_batcher is not None:
+            await sqs_batcher.aclose()
 
 
 def main():
@@ -179,6 +260,7 @@ server.
     p.add_argument("--database-url", default=os.environ.get("DATABASE_URL"))
     args = p.parse_args()
 
+    uvloop.install()
     return asyncio.run(
         execute(seed_prs=args.seed_prs, dry=args.dry, database_url=args.database_url)
     )
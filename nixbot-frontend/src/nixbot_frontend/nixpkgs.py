@@ -1,21 +1,43 @@
 import asyncio
 import os
+import random
+import re
 import time
 import urllib.parse
 from collections import defaultdict
-from typing import Any, AsyncIterator, DefaultDict, Dict, Optional, Set, Tuple
+from functools import lru_cache
+from typing import Any, AsyncIterator, DefaultDict, Dict, List, Mapping, Optional, Set, Tuple, Union
 
 import aiohttp
+import orjson
 from loguru import logger as log
 from nixbot_common import removeprefix
 from typing_extensions import TypedDict
 
 Event = Dict
-NIXPKGS_EVENTS = "https://api.github.com/repos/nixos/nixpkgs/events"
+NIXPKGS_PULLS = (
+    "https://api.github.com/repos/nixos/nixpkgs/pulls"
+    "?state=open&sort=created&direction=desc&per_page=30"
+)
+GITHUB_GRAPHQL = "https://api.github.com/graphql"
+GITHUB_MAX_RETRIES = 5
+GITHUB_MAX_BACKOFF = 300.0
 BLACKLISTED_ATTRS = {
     "tests.nixos-functions.nixos-test",
     "tests.nixos-functions.nixosTest-test",
 }
+_BLACKLISTED_ATTRS_BYTES = frozenset(a.encode() for a in BLACKLISTED_ATTRS)
+# One "<system> <attribute>" pair per line of an ofborg gist
+_GIST_LINE_RE = re.compile(rb"^[ \t]*(\S+)[ \t]+(\S+)[ \t\r]*$", re.MULTILINE)
+OFBORG_EVAL_CONTEXT = "grahamcofborg-eval"
+OFBORG_EVAL_TIMEOUT = 6 * 3600.0  # 6 hours
+# (description, state) of the ofborg statuses that end get_ofborg_eval
+OFBORG_TERMINAL_STATUSES = frozenset(
+    {
+        ("^.^!", "success"),
+        ("This PR does not cleanly list package outputs after merging.", "failure"),
+    }
+)
 OfborgEval = TypedDict(
     "OfborgEval",
     {
@@ -25,6 +47,50 @@ OfborgEval = TypedDict(
 )
 
 
+# When GitHub delivers `status` and `pull_request` webhooks to server.py,
+# those drive get_ofborg_eval and new-PR discovery, and polling is only a
+# fallback.
+WEBHOOK_FALLBACK_POLL_INTERVAL = 15 * 60.0
+# Futures waiting on a webhook, keyed by commit sha (status events) or
+# PR number (pull_request events)
+_webhook_waiters: DefaultDict[Union[str, int], Set[asyncio.Future]] = defaultdict(set)
+
+
+# PRs whose `opened` webhook server.py has already dispatched, so the
+# fallback poll in aiter_nixpkgs_events doesn't dispatch them again
+_webhook_opened_prs: Set[int] = set()
+
+
+def note_webhook_opened_pr(pr: int) -> None:
+    _webhook_opened_prs.add(pr)
+
+
+def notify_webhook(key: Union[str, int], payload: Dict[str, Any]) -> None:
+    for fut in _webhook_waiters.pop(key, ()):
+        if not fut.done():
+            fut.set_result(payload)
+
+
+async def wait_for_webhook(key: Union[str, int], timeout: float) -> Optional[Dict[str, Any]]:
+    fut = asyncio.get_running_loop().create_future()
+    _webhook_waiters[key].add(fut)
+    try:
+        return await asyncio.wait_for(fut, timeout)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        waiters = _webhook_waiters.get(key)
+        if waiters is not None:
+            waiters.discard(fut)
+            if not waiters:
+                del _webhook_waiters[key]
+
+
+# PRs with a get_ofborg_eval in progress
+_evaluating_prs: Set[int] = set()
+
+
+@lru_cache(maxsize=None)
 def github_headers() -> Dict[str, str]:
     return {
         "Authorization": "token %s" % os.environ["GITHUB_TOKEN"],
@@ -32,61 +98,161 @@ def github_headers() -> Dict[str, str]:
     }
 
 
-def union(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
-    c = dict(a)
-    c.update(**b)
-    return c
+def github_session() -> aiohttp.ClientSession:
+    """The one session shared by every GitHub API request the frontend makes.
+
+    The connector keeps connections to api.github.com alive across the
+    per-PR polls, and caps each host so many tracked PRs can't starve
+    the events poll.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=256, limit_per_host=32, keepalive_timeout=120, ttl_dns_cache=300
+        ),
+        headers=github_headers(),
+        json_serialize=lambda obj: orjson.dumps(obj).decode(),
+        timeout=aiohttp.ClientTimeout(total=30, connect=10, sock_read=30),
+    )
+
+
+def backoff_delay(resp: aiohttp.ClientResponse, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying a rate limited or failed GitHub request,
+    or None if `resp` shouldn't be retried."""
+    rate_limited = resp.status == 429 or (
+        resp.status == 403
+        and ("Retry-After" in resp.headers or resp.headers.get("X-RateLimit-Remaining") == "0")
+    )
+    if not rate_limited and resp.status < 500:
+        return None
+    try:
+        return float(resp.headers["Retry-After"])
+    except (KeyError, ValueError):
+        pass
+    if resp.headers.get("X-RateLimit-Remaining") == "0" and "X-RateLimit-Reset" in resp.headers:
+        return max(float(resp.headers["X-RateLimit-Reset"]) - time.time(), 1.0)
+    return min(GITHUB_MAX_BACKOFF, 2 ** attempt + random.random())
+
+
+async def github_request(
+    session: aiohttp.ClientSession, method: str, url: str, **kwargs: Any
+) -> Tuple[int, Mapping[str, str], bytes]:
+    """Make a GitHub request, backing off and retrying while it is rate limited
+    or failing server side. Returns the final status, headers and body."""
+    attempt = 0
+    while True:
+        async with session.request(method, url, **kwargs) as resp:
+            delay = backoff_delay(resp, attempt) if attempt < GITHUB_MAX_RETRIES else None
+            if delay is None:
+                return resp.status, resp.headers, await resp.read()
+        log.warning("Backing off GitHub request", url=url, code=resp.status, sleep_time=delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def gist_session() -> aiohttp.ClientSession:
+    """A separate pool for gist.githubusercontent.com, so gist downloads don't
+    churn the api.github.com connections (and don't carry our API token)."""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=32, keepalive_timeout=120, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=30, connect=10, sock_read=30),
+    )
+
+
+async def conditional_get_json(
+    session: aiohttp.ClientSession, url: str, etag_cache: Dict[str, Tuple[str, Any]]
+) -> Tuple[int, Any]:
+    """GET `url` with If-None-Match from `etag_cache`, which maps each url to
+    its last (etag, parsed body). On a 304 the cached body is returned."""
+    headers: Dict[str, str] = {}
+    cached = etag_cache.get(url)
+    if cached is not None:
+        headers["If-None-Match"] = cached[0]
+
+    status, resp_headers, raw_body = await github_request(session, "GET", url, headers=headers)
+    if status == 304 and cached is not None:
+        return status, cached[1]
+    body = orjson.loads(raw_body)
+    if status == 200 and "ETag" in resp_headers:
+        etag_cache[url] = (resp_headers["ETag"], body)
+    return status, body
 
 
 async def aiter_nixpkgs_events(session: aiohttp.ClientSession) -> AsyncIterator[Event]:
-    base_headers = github_headers()
+    """Yields a PullRequestEvent for every nixpkgs PR opened after we start.
+
+    Rather than the repository events feed, which is mostly unrelated event
+    types, this polls the newest open PRs and remembers the highest number seen.
+    When pull_request webhooks are delivered to server.py, those dispatch new
+    PRs immediately and this only polls rarely, to backfill missed deliveries.
+    """
+    webhooks = bool(os.environ.get("GITHUB_WEBHOOK_SECRET"))
     req_headers: Dict[str, Any] = {}
-    prv_events: Optional[Dict[str, Any]] = None
+    max_seen_pr: Optional[int] = None
     def_poll_interval = 60.0
+    attempt = 0
 
     while True:
-        async with session.get(
-            NIXPKGS_EVENTS, headers=union(base_headers, req_headers)
-        ) as resp:
+        new_prs = []
+        async with session.get(NIXPKGS_PULLS, headers=req_headers) as resp:
             resp_log_data = dict(
                 rate_limits={k: v for k, v in resp.headers.items() if "RateLimit" in k},
                 code=resp.status,
             )
+            # Read (and decompress) the body once, for both logging and parsing
+            raw_body = await resp.read()
             if "Etag" not in resp.headers:
-                resp_log_data["response_body"] = await resp.read()
+                resp_log_data["response_body"] = raw_body
                 resp_log_data["headers"] = resp.headers
 
             if resp.status == 401:
                 log.error(resp.headers)
-                log.error(await resp.text())
+                log.error(raw_body.decode(errors="replace"))
                 raise RuntimeError()
 
             if resp.status == 200:
-                json_body = await resp.json()
-                cur_events = {e["id"]: e for e in json_body}
-
-                resp_log_data["n_events_received"] = len(json_body)
-
-                if prv_events is not None:
-                    new_events = {
-                        k: v for k, v in cur_events.items() if k not in prv_events
-                    }
-
-                    for e in new_events.values():
-                        yield e
-
-                prv_events = cur_events
+                pulls = orjson.loads(raw_body)
+                resp_log_data["n_pulls_received"] = len(pulls)
+
+                if max_seen_pr is not None:
+                    new_prs = [
+                        p
+                        for p in pulls
+                        if p["number"] > max_seen_pr and p["number"] not in _webhook_opened_prs
+                    ]
+                if pulls:
+                    seen = max(max_seen_pr or 0, max(p["number"] for p in pulls))
+                    _webhook_opened_prs.difference_update(
+                        [pr for pr in _webhook_opened_prs if pr <= seen]
+                    )
+                    max_seen_pr = seen
+
+        # Oldest first, as the events feed would have delivered them
+        for pull in sorted(new_prs, key=lambda p: p["number"]):
+            yield {
+                "type": "PullRequestEvent",
+                "payload": {"action": "opened", "number": pull["number"], "pull_request": pull},
+            }
+
+        delay = backoff_delay(resp, attempt)
+        if delay is None:
+            attempt = 0
+            if webhooks:
+                poll_interval = WEBHOOK_FALLBACK_POLL_INTERVAL
+            else:
+                poll_interval = float(resp.headers.get("X-Poll-Interval", def_poll_interval))
+            req_headers = (
+                {"If-None-Match": removeprefix(resp.headers["Etag"], "W/")}
+                if "Etag" in resp.headers
+                else {}
+            )
+        else:
+            # Rate limited or a server error: keep the last ETag and back off
+            attempt += 1
+            poll_interval = delay
 
-        poll_interval = float(resp.headers.get("X-Poll-Interval", def_poll_interval))
-        log.info("Waiting for new events", sleep_time=poll_interval, **resp_log_data)
+        log.info("Waiting for new pull requests", sleep_time=poll_interval, **resp_log_data)
         await asyncio.sleep(poll_interval)
 
-        req_headers = (
-            {"If-None-Match": removeprefix(resp.headers["Etag"], "W/")}
-            if "Etag" in resp.headers
-            else {}
-        )
-
 
 async def get_ofborg_gist_data(
     target_url: str, session: aiohttp.ClientSession
@@ -95,79 +261,238 @@ async def get_ofborg_gist_data(
     assert len(url.path) != 0
     raw_gist_url = f"https://gist.githubusercontent.com/GrahamcOfBorg{url.path}/raw/"
 
-    packages_per_system: DefaultDict[str, Set[str]] = defaultdict(set)
     async with session.get(raw_gist_url) as resp:
-        for line in (await resp.text("utf-8")).splitlines():
-            system, attribute = line.split()
-            if attribute not in BLACKLISTED_ATTRS:
-                packages_per_system[system].add(attribute)
-    return dict(packages_per_system)
+        data = await resp.read()
+
+    # Stay in bytes until the (deduplicated) results are returned
+    packages_per_system: DefaultDict[bytes, Set[bytes]] = defaultdict(set)
+    for system, attribute in _GIST_LINE_RE.findall(data):
+        if attribute not in _BLACKLISTED_ATTRS_BYTES:
+            packages_per_system[system].add(attribute)
+    return {
+        system.decode(): {attribute.decode() for attribute in attributes}
+        for system, attributes in packages_per_system.items()
+    }
+
+
+PULL_REQUEST_STATUSES_BATCH_SIZE = 100
+PULL_REQUEST_STATUSES_BATCH_WINDOW = 1.0
+PULL_REQUEST_STATUSES_FRAGMENT = """
+fragment PullRequestStatuses on PullRequest {
+  isDraft
+  commits(last: 1) {
+    nodes {
+      commit {
+        oid
+        status {
+          contexts { context state description targetUrl }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+class PullRequestStatuses:
+    """Fetches the draft flag, head sha and commit statuses of PRs, coalescing
+    every `fetch` made within PULL_REQUEST_STATUSES_BATCH_WINDOW into a single
+    GraphQL query. Results have the shape of `_get_pull_request_statuses_rest`.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession) -> None:
+        self._session = session
+        self._pending: Dict[int, List[asyncio.Future]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def fetch(self, pr: int) -> Optional[Dict[str, Any]]:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(pr, []).append(fut)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return await fut
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(PULL_REQUEST_STATUSES_BATCH_WINDOW)
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+
+        prs = list(pending)
+        for i in range(0, len(prs), PULL_REQUEST_STATUSES_BATCH_SIZE):
+            batch = prs[i : i + PULL_REQUEST_STATUSES_BATCH_SIZE]
+            try:
+                results = await self._query(batch)
+            except Exception:
+                log.exception("GraphQL statuses query failed", prs=batch)
+                results = {}
+            for pr in batch:
+                for fut in pending[pr]:
+                    if not fut.done():
+                        fut.set_result(results.get(pr))
+
+    async def _query(self, prs: List[int]) -> Dict[int, Dict[str, Any]]:
+        aliases = " ".join(
+            f"pr{pr}: pullRequest(number: {pr}) {{ ...PullRequestStatuses }}" for pr in prs
+        )
+        query = (
+            f'query {{ repository(owner: "NixOS", name: "nixpkgs") {{ {aliases} }} }}'
+            + PULL_REQUEST_STATUSES_FRAGMENT
+        )
+        _, _, raw_body = await github_request(
+            self._session, "POST", GITHUB_GRAPHQL, json={"query": query}
+        )
+        body = orjson.loads(raw_body)
+
+        repository = (body.get("data") or {}).get("repository") or {}
+        results = {}
+        for pr in prs:
+            node = repository.get(f"pr{pr}")
+            if node is None or not node["commits"]["nodes"]:
+                continue
+            commit = node["commits"]["nodes"][0]["commit"]
+            contexts = (commit["status"] or {}).get("contexts", [])
+            results[pr] = {
+                "draft": node["isDraft"],
+                "head": {"sha": commit["oid"]},
+                "statuses": [
+                    {
+                        "context": c["context"],
+                        "state": c["state"].lower(),
+                        "description": c["description"],
+                        "target_url": c["targetUrl"] or "",
+                    }
+                    for c in contexts
+                ],
+            }
+        return results
+
+
+async def _get_pull_request_statuses_rest(
+    session: aiohttp.ClientSession, pull_request_url: str, etag_cache: Dict[str, Tuple[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    _, pr_data = await conditional_get_json(session, pull_request_url, etag_cache)
+    if "statuses_url" not in pr_data:
+        log.error("Malformed pull request respose from github", body=pr_data)
+        return None
+
+    # A draft PR is only slept on, so don't spend a request on its statuses.
+    # Ready ones are always refetched: a new status doesn't bump the PR's
+    # updated_at, and the ETag makes an unchanged list a free 304 anyway
+    if pr_data.get("draft"):
+        return {"draft": True, "head": pr_data["head"], "statuses": []}
+
+    _, statuses = await conditional_get_json(session, pr_data["statuses_url"], etag_cache)
+    return {
+        "draft": pr_data.get("draft"),
+        "head": pr_data["head"],
+        "statuses": statuses,
+    }
+
+
+def _until_next_tick(interval: float) -> float:
+    # Every PR waits for the same ticks, so their polls land in one batch
+    return interval - time.time() % interval
+
+
+def is_evaluating(pr: int) -> bool:
+    return pr in _evaluating_prs
 
 
 async def get_ofborg_eval(
-    event: Dict, session: aiohttp.ClientSession
+    event: Dict,
+    session: aiohttp.ClientSession,
+    statuses: Optional[PullRequestStatuses] = None,
+    gist_session: Optional[aiohttp.ClientSession] = None,
 ) -> Tuple[Event, Optional[OfborgEval]]:
-    clog = log.bind(pr=event["payload"]["number"])
+    pr = event["payload"]["number"]
+    _evaluating_prs.add(pr)
+    try:
+        return await _get_ofborg_eval(event, session, statuses, gist_session or session)
+    finally:
+        _evaluating_prs.discard(pr)
+
+
+async def _get_ofborg_eval(
+    event: Dict,
+    session: aiohttp.ClientSession,
+    statuses: Optional[PullRequestStatuses],
+    gist_session: aiohttp.ClientSession,
+) -> Tuple[Event, Optional[OfborgEval]]:
+    pr = event["payload"]["number"]
+    clog = log.bind(pr=pr)
     pull_request_url = event["payload"]["pull_request"]["_links"]["self"]["href"]
     default_poll_interval = 60.0  # 60 seconds
-    timeout_deadline = time.time() + 6 * 3600  # 6 hours
-    FAILURE_MSG = "This PR does not cleanly list package outputs after merging."
-
-    while True:
-        async with session.get(pull_request_url, headers=github_headers()) as pr_resp:
-            pr_data = await pr_resp.json()
+    if os.environ.get("GITHUB_WEBHOOK_SECRET"):
+        poll_interval = WEBHOOK_FALLBACK_POLL_INTERVAL
+    else:
+        poll_interval = default_poll_interval
+    etag_cache: Dict[str, Tuple[str, Any]] = {}
+
+    # The deadline is kept here rather than with asyncio.wait_for, whose
+    # TimeoutError can't be told apart from that of a single slow request
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + OFBORG_EVAL_TIMEOUT
+
+    def capped(timeout: float) -> float:
+        return max(0.0, min(timeout, deadline - loop.time()))
+
+    while loop.time() < deadline:
+        try:
+            pr_state = await statuses.fetch(pr) if statuses is not None else None
+            if pr_state is None:
+                pr_state = await _get_pull_request_statuses_rest(
+                    session, pull_request_url, etag_cache
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            clog.warning("Error polling github, retrying", error=repr(e))
+            pr_state = None
 
-        if time.time() > timeout_deadline:
-            clog.error("Ofborg timeout, or infinite loop")
-            return event, None
+        if pr_state is None:
+            await asyncio.sleep(capped(default_poll_interval))
+            continue
 
-        if pr_data.get("draft"):
+        if pr_state["draft"]:
             clog.info("Sleeping on draft PR")
-            await asyncio.sleep(default_poll_interval)
+            await wait_for_webhook(pr, capped(_until_next_tick(poll_interval)))
             continue
 
-        if "statuses_url" not in pr_data:
-            clog.error("Malformed pull request respose from github", body=pr_data)
-            await asyncio.sleep(default_poll_interval)
-            continue
+        rjson = pr_state["statuses"]
+        if not isinstance(rjson, list):
+            # e.g. an error object from the REST statuses endpoint
+            clog.error("Ofborg error. statuses not a list?", statuses=rjson)
+            rjson = []
+
+        # Statuses come newest first, so the first ofborg eval status is its
+        # current verdict on this commit
+        status = next((s for s in rjson if s.get("context") == OFBORG_EVAL_CONTEXT), None)
+        if status is not None and (status.get("description"), status.get("state")) not in OFBORG_TERMINAL_STATUSES:
+            status = None
+        if status is not None and status["state"] == "failure":
+            clog.info("Ofborg failure", state="finished")
+            return event, None
 
-        async with session.get(
-            pr_data["statuses_url"], headers=github_headers()
-        ) as resp:
-            rjson = await resp.json()
+        if status is not None:
+            if status["target_url"] == "":
+                clog.info("Ofborg reports no packages", state="finished")
+                return event, None
 
-        for status in rjson:
-            if not isinstance(status, dict):
-                clog.error("Ofborg error. status not dict?", status=status)
+            try:
+                packages_per_system = await get_ofborg_gist_data(status["target_url"], gist_session)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                clog.warning("Error fetching ofborg gist, retrying", error=repr(e))
+                await asyncio.sleep(capped(default_poll_interval))
                 continue
+            clog.info("Ofborg success", state="finished")
+            return event, {
+                "url": status["target_url"],
+                "packages_per_system": packages_per_system,
+            }
 
-            if status.get("description") == "^.^!" and status.get("state") == "success":
-                if status["target_url"] == "":
-                    clog.info("Ofborg reports no packages", state="finished")
-                    return event, None
+        clog.info("Waiting for ofborg", sleep_time=poll_interval)
+        await wait_for_webhook(pr_state["head"]["sha"], capped(_until_next_tick(poll_interval)))
 
-                packages_per_system = await get_ofborg_gist_data(
-                    status["target_url"], session
-                )
-                clog.info("Ofborg success", state="finished")
-                return event, {
-                    "url": status["target_url"],
-                    "packages_per_system": packages_per_system,
-                }
-
-            if (
-                status.get("description") == FAILURE_MSG
-                and status.get("state") == "failure"
-            ):
-                clog.info("Ofborg failure", state="finished")
-                return event, None
-
-        clog.info(
-            "Waiting for ofborg",
-            sleep_time=default_poll_interval,
-            code=resp.status,
-        )
-        await asyncio.sleep(default_poll_interval)
+    clog.error("Ofborg timeout, or infinite loop")
+    return event, None
 
 
 def event_is_pull_request_opened(e: Event) -> bool:
@@ -192,17 +517,15 @@ def event_is_pull_request_opened(e: Event) -> bool:
 
 async def pr_number_as_pull_event(pr: int, session: aiohttp.ClientSession) -> Event:
     pull_url = f"https://api.github.com/repos/NixOS/nixpkgs/pulls/{pr}"
-    async with session.get(pull_url, headers=github_headers()) as resp:
+    async with session.get(pull_url) as resp:
+        body = orjson.loads(await resp.read())
         if resp.status != 200:
             # Could be auth problem with github token like
             # {'message': 'Bad credentials', 'documentation_url': 'https://docs.github.com/rest'}}}
             # Or something else?
-            log.error(
-                headers=resp.headers, status=resp.status, body=(await resp.json())
-            )
-            raise RuntimeError(await resp.json())
+            log.error(headers=resp.headers, status=resp.status, body=body)
+            raise RuntimeError(body)
 
-        body = await resp.json()
         return {
             "type": "PullRequestEvent",
             "payload": {"action": "opened", "number": pr, "pull_request": body},
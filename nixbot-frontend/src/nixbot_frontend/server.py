@@ -1,14 +1,25 @@
 import asyncio
+import hashlib
+import hmac
 import json
+import os
 from functools import partial
+from typing import Set, Union
 
 import aiohttp
+import orjson
 from aiohttp import web
 
-from .nixpkgs import pr_number_as_pull_event
+from .nixpkgs import Event, is_evaluating, note_webhook_opened_pr, notify_webhook, pr_number_as_pull_event
 
+# PRs posted to us (or opened, per webhook) but not yet picked up; beyond
+# this, posts get a 503
+SERVER_QUEUE_MAXSIZE = 1024
 
-async def handle_request(queue: asyncio.Queue, request: web.Request) -> web.Response:
+
+async def handle_request(
+    queue: asyncio.Queue, queued: Set[int], request: web.Request
+) -> web.Response:
     try:
         data = await request.json()
     except json.decoder.JSONDecodeError:
@@ -19,17 +30,66 @@ async def handle_request(queue: asyncio.Queue, request: web.Request) -> web.Resp
     except (KeyError, AssertionError):
         raise web.HTTPUnprocessableEntity()
 
-    queue.put_nowait(pr)
+    if pr in queued or is_evaluating(pr):
+        return web.json_response({"status": "dedup"})
+    try:
+        queue.put_nowait(pr)
+    except asyncio.QueueFull:
+        raise web.HTTPServiceUnavailable()
+    queued.add(pr)
+    return web.json_response({"status": "ok"})
+
+
+async def handle_webhook(
+    secret: bytes, queue: asyncio.Queue, queued: Set[int], request: web.Request
+) -> web.Response:
+    body = await request.read()
+    signature = b"sha256=" + hmac.new(secret, body, hashlib.sha256).hexdigest().encode()
+    # Compared as bytes, since compare_digest raises TypeError on a str with
+    # non-ASCII characters in it, which the client controls
+    header = request.headers.get("X-Hub-Signature-256", "").encode("utf-8", "surrogateescape")
+    if not hmac.compare_digest(signature, header):
+        raise web.HTTPUnauthorized()
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise web.HTTPBadRequest()
+
+    event_type = request.headers.get("X-GitHub-Event")
+    if event_type == "status":
+        notify_webhook(data["sha"], data)
+    elif event_type == "pull_request":
+        pr = data["number"]
+        notify_webhook(pr, data)
+        if data["action"] == "opened":
+            if pr not in queued and not is_evaluating(pr):
+                # The payload already has the event's shape, so unlike posted
+                # PR numbers it doesn't need fetching again
+                try:
+                    queue.put_nowait({"type": "PullRequestEvent", "payload": data})
+                except asyncio.QueueFull:
+                    # Not noted as dispatched, so the fallback poll still
+                    # picks it up
+                    raise web.HTTPServiceUnavailable()
+                queued.add(pr)
+            note_webhook_opened_pr(pr)
     return web.json_response({"status": "ok"})
 
 
-async def server(queue: asyncio.Queue) -> None:
+async def server(queue: asyncio.Queue, queued: Set[int]) -> None:
     app = web.Application()
     app.add_routes(
         [
-            web.post("/", partial(handle_request, queue)),
+            web.post("/", partial(handle_request, queue, queued)),
         ]
     )
+    # GitHub status/pull_request webhooks, relayed to this port by the
+    # reverse proxy in front of us
+    webhook_secret = os.environ.get("GITHUB_WEBHOOK_SECRET")
+    if webhook_secret:
+        app.add_routes(
+            [web.post("/webhook", partial(handle_webhook, webhook_secret.encode(), queue, queued))]
+        )
 
     # https://docs.aiohttp.org/en/stable/web_advanced.html#aiohttp-web-app-runners
     runner = web.AppRunner(app)
@@ -41,13 +101,22 @@ async def server(queue: asyncio.Queue) -> None:
 
 
 async def aiter_server_events(client_session: aiohttp.ClientSession):
-    queue: asyncio.Queue = asyncio.Queue()
-    server_task: asyncio.Task = asyncio.create_task(server(queue))
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SERVER_QUEUE_MAXSIZE)
+    # PRs in the queue or being resolved to an event, so repeated posts of a
+    # PR that is already on its way to get_ofborg_eval are dropped
+    queued: Set[int] = set()
+    server_task: asyncio.Task = asyncio.create_task(server(queue, queued))
 
     while True:
-        pr: int = await queue.get()
-        event = await pr_number_as_pull_event(pr, client_session)
-        yield event
+        item: Union[int, Event] = await queue.get()
+        pr = item if isinstance(item, int) else item["payload"]["number"]
+        try:
+            if isinstance(item, int):
+                yield await pr_number_as_pull_event(item, client_session)
+            else:
+                yield item
+        finally:
+            queued.discard(pr)
 
     # Wait for server to shutdown (never)
     await asyncio.gather(server_task, return_exceptions=True)
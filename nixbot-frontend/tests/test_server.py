@@ -0,0 +1,55 @@
+import asyncio
+import hashlib
+import hmac
+import json
+from functools import partial
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from nixbot_frontend.server import handle_webhook
+
+SECRET = b"webhook-secret"
+
+
+def sign(body: bytes) -> str:
+    return "sha256=" + hmac.new(SECRET, body, hashlib.sha256).hexdigest()
+
+
+async def post_webhook(body: bytes, headers):
+    queue: asyncio.Queue = asyncio.Queue()
+    app = web.Application()
+    app.add_routes([web.post("/webhook", partial(handle_webhook, SECRET, queue, set()))])
+    async with TestClient(TestServer(app)) as client:
+        resp = await client.post("/webhook", data=body, headers=headers)
+        return resp.status, queue
+
+
+def test_webhook_accepts_valid_signature():
+    body = json.dumps(
+        {"action": "opened", "number": 1234, "pull_request": {}}
+    ).encode()
+    headers = {"X-GitHub-Event": "pull_request", "X-Hub-Signature-256": sign(body)}
+    status, queue = asyncio.run(post_webhook(body, headers))
+    assert status == 200
+    assert queue.get_nowait()["payload"]["number"] == 1234
+
+
+def test_webhook_rejects_bad_signature():
+    body = json.dumps({"sha": "abc"}).encode()
+    headers = {"X-GitHub-Event": "status", "X-Hub-Signature-256": sign(b"something else")}
+    status, _ = asyncio.run(post_webhook(body, headers))
+    assert status == 401
+
+
+def test_webhook_rejects_missing_signature():
+    body = json.dumps({"sha": "abc"}).encode()
+    status, _ = asyncio.run(post_webhook(body, {"X-GitHub-Event": "status"}))
+    assert status == 401
+
+
+def test_webhook_rejects_non_ascii_signature():
+    body = json.dumps({"sha": "abc"}).encode()
+    headers = {"X-GitHub-Event": "status", "X-Hub-Signature-256": "sha256=é"}
+    status, _ = asyncio.run(post_webhook(body, headers))
+    assert status == 401